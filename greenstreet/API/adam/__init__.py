@@ -1,3 +1,4 @@
 from greenstreet.API.adam.panorama_job import AdamPanoramaJob
 from greenstreet.API.adam.cubic_job import AdamCubicJob
 from greenstreet.API.adam.meta import AdamMetaData
+from greenstreet.API.adam.meta_db import AdamMetaDatabase
@@ -1,118 +1,358 @@
+import os
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import requests
-from time import sleep
 from json.decoder import JSONDecodeError
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from greenstreet.API.base.fetch import FetchPolicy
+from greenstreet.utils.spatial import SpatialIndex
+from greenstreet.utils.time_conversion import get_time_from_str
+
+
+# Query parameter of the API to only get panoramas after some time.
+TIMESTAMP_AFTER = "timestamp_after"
+
+# Panoramas can be published some time after they were taken, so a refresh
+# also requests the panoramas of this period before the newest stored one.
+REFRESH_OVERLAP = timedelta(days=30)
 
 
 class AdamMetaData():
+    """ Meta data of panoramas from data.amsterdam.
+
+    Besides the raw meta data per panorama, a columnar representation
+    is kept with the pano_ids, coordinates, timestamps and tags as numpy
+    arrays. In columnar mode (see from_file) the raw meta data is only
+    loaded from disk when it is actually needed.
+    """
     name = "adam"
 
     def __init__(self, param={}):
-        self.meta_data = {}
+        self._meta_data = {}
+        self._meta_fp = None
+        self._meta_loader = None
+        self._columns = None
+        self._index = None
+        self._spatial_index = None
         self.param = param
         self.meta_timestamp = str(datetime.now())
 
+    @property
+    def meta_data(self):
+        " Raw meta data {pano_id: meta}, loaded lazily in columnar mode. "
+        if self._meta_data is None:
+            if self._meta_loader is not None:
+                self._meta_data = self._meta_loader()
+            else:
+                with open(self._meta_fp, "r") as fp:
+                    self._meta_data = json.load(fp)["meta_data"]
+        return self._meta_data
+
+    @meta_data.setter
+    def meta_data(self, meta_data):
+        self._meta_data = meta_data
+        self._columns = None
+        self._index = None
+        self._spatial_index = None
+
+    @property
+    def columns(self):
+        """ Columnar meta data.
+
+        Returns
+        -------
+        dict:
+            pano_ids: array of str, coordinates: (n, 2) float64 array of
+            (longitude, latitude), timestamp_str: array of str,
+            timestamps: datetime64 array, tags: uint64 bitmask array,
+            tag_names: the tag for each bit in the mask.
+        """
+        if self._columns is None:
+            self._columns = _to_columns(self.meta_data)
+        return self._columns
+
+    @property
+    def pano_ids(self):
+        return self.columns["pano_ids"]
+
+    @property
+    def index(self):
+        " {pano_id: row} in the columnar arrays. "
+        if self._index is None:
+            self._index = {pano_id: i for i, pano_id in
+                           enumerate(self.pano_ids.tolist())}
+        return self._index
+
+    @property
+    def spatial_index(self):
+        """ KD-tree over the coordinates of the panoramas.
+
+        In columnar mode, the index is persisted next to the meta data.
+        """
+        if self._spatial_index is None:
+            index_fp = None
+            if self._meta_fp is not None:
+                index_fp = os.path.splitext(self._meta_fp)[0] + ".kdtree"
+                if (os.path.exists(index_fp) and os.path.getmtime(index_fp)
+                        >= os.path.getmtime(self._meta_fp)):
+                    self._spatial_index = SpatialIndex.load(index_fp)
+            if self._spatial_index is not None:
+                return self._spatial_index
+            self._spatial_index = SpatialIndex(self.coordinate_array())
+            if index_fp is not None:
+                self._spatial_index.save(index_fp)
+        return self._spatial_index
+
+    def in_bbox(self, bbox):
+        " Rows of the panoramas within a bounding box (sorted). "
+        return self.spatial_index.in_bbox(bbox)
+
+    def nearest(self, lat, long, k=1):
+        " Rows and distances (m) of the k nearest panoramas to a point. "
+        return self.spatial_index.nearest(lat, long, k=k)
+
+    def subset(self, rows):
+        " New meta data instance with only some of the panoramas. "
+        pano_ids = self.pano_ids[rows].tolist()
+        meta = self.__class__(param=self.param)
+        meta.meta_timestamp = self.meta_timestamp
+        meta.meta_data = {pano_id: self.meta_data[pano_id]
+                          for pano_id in pano_ids}
+        return meta
+
+    def __len__(self):
+        return len(self.pano_ids)
+
+    def coordinate_array(self):
+        " (n, 2) array with longitude and latitude of all panoramas. "
+        return self.columns["coordinates"]
+
+    def timestamp_array(self):
+        return self.columns["timestamps"]
+
+    def tag_mask(self, tag):
+        " Boolean array that is True for panoramas with a tag. "
+        tag_names = self.columns["tag_names"].tolist()
+        if tag not in tag_names:
+            return np.zeros(len(self), dtype=bool)
+        bit = np.uint64(1) << np.uint64(tag_names.index(tag))
+        return (self.columns["tags"] & bit) != 0
+
     def coordinates(self, idx=None):
-        return self._get(_coordinate, idx=idx)
+        coor = self.coordinate_array()
+        if idx is None:
+            coor = coor.tolist()
+            return self._get(lambda i: tuple(coor[i]))
+        return self._get(lambda i: (float(coor[i, 0]), float(coor[i, 1])),
+                         idx=idx)
 
     def timestamps(self, idx=None):
-        return self._get(_timestamp, idx=idx)
+        timestamps = self.columns["timestamp_str"]
+        if idx is None:
+            timestamps = timestamps.tolist()
+            return self._get(lambda i: timestamps[i])
+        return self._get(lambda i: str(timestamps[i]), idx=idx)
 
     def _get(self, extractor, idx=None):
         if idx is None:
-            idx = list(self.meta_data)
+            idx = self.pano_ids.tolist()
 
         iterable = True
         if not isinstance(idx, list):
             idx = [idx]
             iterable = False
 
-        coor_list = {i: extractor(self.meta_data[i]) for i in idx}
+        index = self.index
+        coor_list = {i: extractor(index[i]) for i in idx}
 
         if iterable:
             return coor_list
         return coor_list[idx[0]]
 
     @classmethod
-    def from_file(cls, meta_fp):
+    def from_file(cls, meta_fp, columnar=False):
+        """ Load meta data from a file.
+
+        Arguments
+        ---------
+        meta_fp: str
+            File written by to_file or download_to_file.
+        columnar: bool
+            Only load the columnar meta data, from a .npz file next to the
+            meta data file (which is created if not up-to-date). The raw
+            meta data is loaded when it is first needed.
+        """
+        if columnar:
+            col_fp = _columns_fp(meta_fp)
+            if (os.path.exists(col_fp) and os.path.getmtime(col_fp)
+                    >= os.path.getmtime(meta_fp)):
+                return cls._from_columns(meta_fp, col_fp)
+
         with open(meta_fp, "r") as fp:
             meta_dict = json.load(fp)
         meta = cls(param=meta_dict["param"])
         meta.meta_data = meta_dict["meta_data"]
         meta.meta_timestamp = meta_dict["timestamp"]
+        if columnar:
+            meta._meta_fp = str(meta_fp)
+            meta._save_columns(_columns_fp(meta_fp))
         return meta
 
     @classmethod
-    def from_download(cls, param, filter_water=True):
-        url = "https://api.data.amsterdam.nl/panorama/panoramas/"
-        meta_list = []
-
-        param = _request_params(**param)
-        MAX_TRIES = 10
-        n_try = 0
-        while n_try < MAX_TRIES:
-            try:
-                response = requests.get(url, params=param)
-            except requests.exceptions.RequestException:
-                print("HTTP request failed.")
-                sleep(60)
-
-            if response.status_code == 200:
-                break
-            else:
-                print(
-                    f"Error (data.amsterdam): HTTP status code:"
-                    f" {response.status_code}"
-                )
-                sleep(60)
-            n_try += 1
-
-        if n_try == MAX_TRIES:
-            raise ValueError("Error (data.amsterdam): Error retrieving meta"
-                             " data.")
-
-        # Try to load data into a dictionary.
-        try:
-            response_dict = json.loads(response.content)
-        except JSONDecodeError:
-            print("Error (data.amsterdam): response not in correct format.")
-            raise ValueError(response.content)
-
-        new_list = _convert_meta(response_dict["_embedded"]["panoramas"])
-        meta_list.extend(new_list)
-
-        while response_dict['_links']['next']['href'] is not None:
-            n_try = 0
-            while n_try < MAX_TRIES:
-                try:
-                    response = requests.get(
-                        response_dict['_links']['next']['href'])
-                    break
-                except requests.RequestException:
-                    print(f"Error (data.amsterdam) HTTP request failed.")
-                    sleep(60)
-                    n_try += 1
-            if n_try == MAX_TRIES:
-                raise ValueError(
-                    f"HTTP request failed with code {response.status_code}"
-                )
-            response_dict = json.loads(response.content)
-            new_list = _convert_meta(
-                response_dict["_embedded"]["panoramas"])
-            # Add new meta-data to list.
-            meta_list.extend(new_list)
-        meta_data = {meta["pano_id"]: meta for meta in meta_list
-                     if not (filter_water and "surface-water" in meta["tags"])}
-        meta_instance = cls(param=param)
-        meta_instance.meta_data = meta_data
+    def _from_columns(cls, meta_fp, col_fp):
+        with np.load(col_fp) as col_data:
+            columns = {key: col_data[key] for key in col_data.files}
+        header = json.loads(str(columns.pop("header")))
+        meta = cls(param=header["param"])
+        meta.meta_timestamp = header["timestamp"]
+        meta._meta_data = None
+        meta._meta_fp = str(meta_fp)
+        meta._columns = columns
+        return meta
+
+    @classmethod
+    def from_columns(cls, param, pano_ids, coordinates, timestamps, tags,
+                     meta_loader, meta_timestamp=None):
+        """ Create meta data from columns, loading the raw data lazily.
+
+        Arguments
+        ---------
+        param: dict
+            Parameters of the query.
+        pano_ids, coordinates, timestamps, tags: list
+            Panorama ids, (longitude, latitude), timestamp strings and
+            lists of tags, one item per panorama.
+        meta_loader: function
+            Returns the raw meta data {pano_id: meta} when called.
+        meta_timestamp: str
+            Time the meta data was retrieved.
+        """
+        meta = cls(param=param)
+        if meta_timestamp is not None:
+            meta.meta_timestamp = meta_timestamp
+        meta._meta_data = None
+        meta._meta_loader = meta_loader
+        meta._columns = _columns_from_lists(pano_ids, coordinates, timestamps,
+                                            tags)
+        return meta
+
+    def _save_columns(self, col_fp):
+        header = json.dumps({"param": self.param,
+                             "timestamp": str(self.meta_timestamp)})
+        np.savez(col_fp, header=np.array(header), **self.columns)
+
+    @classmethod
+    def from_download(cls, param, filter_water=True, policy=None):
+        meta_instance = cls(param=_request_params(**param))
+        meta_instance.meta_data = {
+            meta["pano_id"]: meta
+            for meta in iter_download(param, filter_water=filter_water,
+                                      policy=policy)
+        }
         return meta_instance
 
+    @classmethod
+    def download_to_file(cls, param, meta_fp, filter_water=True,
+                         policy=None, columnar=False):
+        """ Download the meta data and stream it directly to a file.
+
+        The file has the same format as the one written by to_file, but
+        the meta data is never held in memory as a whole: only the page
+        that is being converted and the one that is being fetched.
+
+        With columnar, the columnar meta data file is built while
+        streaming as well, so that from_file(columnar=True) does not have
+        to parse the meta data file afterwards.
+
+        Returns
+        -------
+        int:
+            Number of panoramas written to the file.
+        """
+        meta_fp = str(meta_fp)
+        tmp_fp = meta_fp + ".part"
+        header = {
+            "name": cls.name,
+            "param": _request_params(**param),
+            "timestamp": str(datetime.now()),
+        }
+        columns = {"pano_ids": [], "coordinates": [], "timestamps": [],
+                   "tags": []}
+        n_meta = 0
+        with open(tmp_fp, "w") as fp:
+            fp.write(json.dumps(header)[:-1] + ', "meta_data": {')
+            for meta in iter_download(param, filter_water=filter_water,
+                                      policy=policy):
+                if n_meta:
+                    fp.write(", ")
+                fp.write(json.dumps(meta["pano_id"]) + ": " + json.dumps(meta))
+                n_meta += 1
+                if columnar:
+                    columns["pano_ids"].append(meta["pano_id"])
+                    columns["coordinates"].append(_coordinate(meta))
+                    columns["timestamps"].append(_timestamp(meta))
+                    columns["tags"].append(meta.get("tags", []))
+            fp.write("}}")
+        os.replace(tmp_fp, meta_fp)
+        if columnar:
+            # Written after the meta data file, so that it is up-to-date.
+            meta = cls.from_columns(header["param"], meta_loader=None,
+                                    meta_timestamp=header["timestamp"],
+                                    **columns)
+            meta._save_columns(_columns_fp(meta_fp))
+        return n_meta
+
+    def update(self, filter_water=True, policy=None):
+        """ Download only the panoramas newer than the stored meta data.
+
+        Panoramas taken after the newest stored panorama (minus
+        REFRESH_OVERLAP) are requested. They are merged into the meta
+        data, replacing panoramas that were stored already, and the
+        meta_timestamp is updated.
+
+        Returns
+        -------
+        list:
+            Pano ids of the panoramas that were not in the meta data yet.
+        """
+        new_timestamp = str(datetime.now())
+        param = dict(self.param)
+        if len(self):
+            newest = np.datetime_as_string(self.timestamp_array().max(),
+                                           unit="us")
+            param[TIMESTAMP_AFTER] = _refresh_after(newest)
+        meta_data = self.meta_data
+        new_ids = []
+        for meta in iter_download(param, filter_water=filter_water,
+                                  policy=policy):
+            if meta["pano_id"] not in meta_data:
+                new_ids.append(meta["pano_id"])
+            meta_data[meta["pano_id"]] = meta
+        self.meta_data = meta_data
+        self.meta_timestamp = new_timestamp
+        return new_ids
+
     def param_str(self):
         param_str = [str(key) + "=" + str(value)
                      for key, value in self.param.items()]
         return "_".join(param_str) + ".json"
 
+    def pano_meta(self, pano_id):
+        " Meta data of a single panorama, in the per panorama format. "
+        longitude, latitude = self.coordinates(pano_id)
+        return {
+            "name": self.name,
+            "meta_timestamp": str(self.meta_timestamp),
+            "pano_timestamp": self.timestamps(pano_id),
+            "latitude": latitude,
+            "longitude": longitude,
+            "pano_id": pano_id,
+            "meta_data": self.meta_data[pano_id]
+        }
+
     def to_file(self, meta_fp, pano_id=None):
         if pano_id is None:
             meta_dict = {
@@ -122,17 +362,95 @@ class AdamMetaData():
                 "meta_data": self.meta_data
             }
         else:
-            meta_dict = {
-                "name": self.name,
-                "meta_timestamp": str(self.meta_timestamp),
-                "pano_timestamp": self.timestamps(pano_id),
-                "latitude": self.coordinates(pano_id)[1],
-                "longitude": self.coordinates(pano_id)[0],
-                "pano_id": pano_id,
-                "meta_data": self.meta_data[pano_id]
-            }
+            meta_dict = self.pano_meta(pano_id)
         with open(meta_fp, "w") as fp:
             json.dump(meta_dict, fp)
+        if pano_id is None and os.path.exists(_columns_fp(meta_fp)):
+            self._save_columns(_columns_fp(meta_fp))
+
+
+def _refresh_after(newest_timestamp, overlap=REFRESH_OVERLAP):
+    """ Value of TIMESTAMP_AFTER to refresh stored meta data.
+
+    The cut-off is derived from the newest stored panorama, not from the
+    time of retrieval, so that both are in UTC like the API.
+
+    Arguments
+    ---------
+    newest_timestamp: str
+        Timestamp of the newest stored panorama, e.g.
+        "2019-04-01T10:12:33Z" (the Z is optional).
+    overlap: timedelta
+        Period before the newest panorama that is requested again.
+    """
+    newest_timestamp = str(newest_timestamp)
+    if not newest_timestamp.endswith("Z"):
+        newest_timestamp += "Z"
+    cut_off = get_time_from_str(newest_timestamp) - overlap
+    return cut_off.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def iter_download(param, filter_water=True, policy=None):
+    """ Iterate over the meta data of all panoramas from data.amsterdam.
+
+    The next page is fetched in the background while the records of the
+    current page are converted and consumed.
+
+    Arguments
+    ---------
+    param: dict
+        Query parameters, see _request_params.
+    filter_water: bool
+        Skip panoramas taken on the water.
+    policy: FetchPolicy
+        Retry/rate limit policy for the requests.
+
+    Returns
+    -------
+    generator:
+        Converted meta data of one panorama at a time.
+    """
+    url = "https://api.data.amsterdam.nl/panorama/panoramas/"
+    if policy is None:
+        policy = FetchPolicy(n_try=10, max_delay=120)
+
+    for page in _iter_pages(url, _request_params(**param), policy):
+        for meta in _convert_meta(page):
+            if not (filter_water and "surface-water" in meta["tags"]):
+                yield meta
+
+
+def _iter_pages(url, param, policy):
+    " Iterate over pages, prefetching the next page in a thread. "
+    session = requests.Session()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(_fetch_page, session, policy, url, param)
+        while future is not None:
+            response_dict = future.result()
+            # The next link already includes the parameters.
+            next_url = response_dict['_links']['next']['href']
+            if next_url is None:
+                future = None
+            else:
+                future = executor.submit(_fetch_page, session, policy,
+                                         next_url, None)
+            yield response_dict["_embedded"]["panoramas"]
+    session.close()
+
+
+def _fetch_page(session, policy, url, param):
+    try:
+        response = policy.get(session, url, params=param)
+    except requests.RequestException as e:
+        raise ValueError("Error (data.amsterdam): Error retrieving"
+                         f" meta data: {e}")
+
+    # Try to load data into a dictionary.
+    try:
+        return json.loads(response.content)
+    except JSONDecodeError:
+        print("Error (data.amsterdam): response not in correct format.")
+        raise ValueError(response.content)
 
 
 def _request_params(center=None, radius=None, **kwargs):
@@ -175,6 +493,47 @@ def _convert_meta(meta_data):
     return all_dict
 
 
+def _columns_fp(meta_fp):
+    return os.path.splitext(str(meta_fp))[0] + ".npz"
+
+
+def _to_columns(meta_data):
+    " Convert the raw meta data to numpy arrays. "
+    pano_ids = list(meta_data)
+    return _columns_from_lists(
+        pano_ids,
+        [_coordinate(meta_data[i]) for i in pano_ids],
+        [_timestamp(meta_data[i]) for i in pano_ids],
+        [meta_data[i].get("tags", []) for i in pano_ids])
+
+
+def _columns_from_lists(pano_ids, coordinates, timestamp_str, tag_lists):
+    " Create the columnar arrays from lists with one item per panorama. "
+    coordinates = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+
+    tag_names = []
+    tags = np.zeros(len(pano_ids), dtype=np.uint64)
+    for i_pano, tag_list in enumerate(tag_lists):
+        mask = 0
+        for tag in tag_list:
+            if tag not in tag_names:
+                if len(tag_names) == 64:
+                    raise ValueError("Too many different tags for bitmask.")
+                tag_names.append(tag)
+            mask |= 1 << tag_names.index(tag)
+        tags[i_pano] = mask
+
+    return {
+        "pano_ids": np.array(pano_ids, dtype=str),
+        "coordinates": coordinates,
+        "timestamp_str": np.array(timestamp_str, dtype=str),
+        "timestamps": np.array([t.rstrip("Z") for t in timestamp_str],
+                               dtype="datetime64[us]"),
+        "tags": tags,
+        "tag_names": np.array(tag_names, dtype=str),
+    }
+
+
 def _coordinate(meta):
     return (meta["geometry"]["coordinates"][0],
             meta["geometry"]["coordinates"][1])
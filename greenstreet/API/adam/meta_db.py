@@ -0,0 +1,263 @@
+'''
+Regional database with the meta data of all panoramas, with an R-tree
+index on their coordinates.
+'''
+
+import json
+import sqlite3
+from datetime import datetime
+
+from greenstreet.API.adam.meta import AdamMetaData, iter_download,\
+    _request_params, _coordinate, _timestamp, _refresh_after, TIMESTAMP_AFTER
+
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS panorama ("
+    " id INTEGER PRIMARY KEY,"
+    " pano_id TEXT UNIQUE NOT NULL,"
+    " longitude REAL NOT NULL,"
+    " latitude REAL NOT NULL,"
+    " timestamp TEXT NOT NULL,"
+    " tags TEXT NOT NULL,"
+    " meta TEXT NOT NULL)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS panorama_rtree USING rtree("
+    " id, min_long, max_long, min_lat, max_lat)",
+    "CREATE TABLE IF NOT EXISTS coverage ("
+    " id INTEGER PRIMARY KEY,"
+    " min_lat REAL, min_long REAL, max_lat REAL, max_long REAL,"
+    " param TEXT,"
+    " meta_timestamp TEXT)",
+]
+
+
+class AdamMetaDatabase():
+    """ SQLite store with meta data of all panoramas in a data directory.
+
+    Tiles query the panoramas within their bounding box, which only
+    requires a download from data.amsterdam if that bounding box has not
+    been retrieved before. Panoramas are stored once, even if they are on
+    the boundary of multiple tiles.
+
+    Arguments
+    ---------
+    db_fp: str
+        SQLite database file.
+    """
+    meta_class = AdamMetaData
+
+    def __init__(self, db_fp):
+        self.db_fp = str(db_fp)
+        self.conn = sqlite3.connect(self.db_fp, timeout=60)
+        with self.conn:
+            for statement in _SCHEMA:
+                self.conn.execute(statement)
+
+    def covers(self, bbox):
+        " Whether the meta data of a bounding box has been downloaded. "
+        row = self.conn.execute(
+            "SELECT id FROM coverage WHERE min_lat <= ? AND min_long <= ?"
+            " AND max_lat >= ? AND max_long >= ? LIMIT 1",
+            (bbox[0][0], bbox[0][1], bbox[1][0], bbox[1][1])).fetchone()
+        return row is not None
+
+    def download(self, bbox, param, filter_water=True, policy=None):
+        """ Download the meta data of a bounding box into the database.
+
+        Returns
+        -------
+        list:
+            Pano ids of all panoramas that were retrieved.
+        """
+        meta_timestamp = str(datetime.now())
+        pano_ids = self.insert(
+            iter_download(param, filter_water=filter_water, policy=policy))
+        self._add_coverage(bbox, _request_params(**param), meta_timestamp)
+        return pano_ids
+
+    def import_file(self, bbox, param, meta_fp):
+        """ Import the meta data of a bounding box from a meta data file.
+
+        Data directories from before the database have a meta.json file
+        per tile, which is imported instead of downloading it again.
+
+        Returns
+        -------
+        list:
+            Pano ids of all panoramas in the file.
+        """
+        meta = self.meta_class.from_file(meta_fp)
+        pano_ids = self.insert(meta.meta_data.values())
+        self._add_coverage(bbox, _request_params(**param),
+                           meta.meta_timestamp)
+        return pano_ids
+
+    def _add_coverage(self, bbox, request_param, meta_timestamp):
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO coverage (min_lat, min_long, max_lat, max_long,"
+                " param, meta_timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                (bbox[0][0], bbox[0][1], bbox[1][0], bbox[1][1],
+                 json.dumps(request_param), str(meta_timestamp)))
+
+    def refresh(self, filter_water=True, policy=None):
+        """ Download panoramas that are newer than the stored meta data.
+
+        For every bounding box that was downloaded before, only the
+        panoramas taken after the newest stored panorama in that bounding
+        box (minus REFRESH_OVERLAP) are requested. Panoramas that were
+        stored already are updated.
+
+        Returns
+        -------
+        list:
+            Pano ids of panoramas that were not in the database before.
+        """
+        coverage = self.conn.execute(
+            "SELECT id, param, min_lat, min_long, max_lat, max_long"
+            " FROM coverage").fetchall()
+        new_ids = []
+        for cov_id, param, *bbox in coverage:
+            param = json.loads(param)
+            newest = self.newest_timestamp([bbox[:2], bbox[2:]])
+            if newest is not None:
+                param[TIMESTAMP_AFTER] = _refresh_after(newest)
+            new_timestamp = str(datetime.now())
+            new_ids.extend(self.insert(
+                iter_download(param, filter_water=filter_water,
+                              policy=policy),
+                only_new=True))
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE coverage SET meta_timestamp = ? WHERE id = ?",
+                    (new_timestamp, cov_id))
+        return list(dict.fromkeys(new_ids))
+
+    def newest_timestamp(self, bbox):
+        " Timestamp of the newest panorama in a bounding box, or None. "
+        row = self.conn.execute(
+            "SELECT MAX(p.timestamp)"
+            " FROM panorama_rtree AS r JOIN panorama AS p ON p.id = r.id"
+            " WHERE r.max_long >= ? AND r.min_long <= ?"
+            " AND r.max_lat >= ? AND r.min_lat <= ?",
+            (bbox[0][1], bbox[1][1], bbox[0][0], bbox[1][0])).fetchone()
+        return row[0]
+
+    def insert(self, meta_iter, chunk_size=2000, only_new=False):
+        """ Insert or update the meta data of panoramas.
+
+        Arguments
+        ---------
+        meta_iter: iterable
+            Raw meta data, one panorama at a time.
+        chunk_size: int
+            Number of panoramas per transaction.
+        only_new: bool
+            Only return the pano ids that were not in the database before.
+
+        Returns
+        -------
+        list:
+            Pano ids of all inserted panoramas.
+        """
+        pano_ids = []
+        chunk = []
+        for meta in meta_iter:
+            chunk.append(meta)
+            if len(chunk) >= chunk_size:
+                pano_ids.extend(self._insert_chunk(chunk, only_new))
+                chunk = []
+        pano_ids.extend(self._insert_chunk(chunk, only_new))
+        return pano_ids
+
+    def _insert_chunk(self, chunk, only_new=False):
+        if only_new:
+            known = set(self.records([meta["pano_id"] for meta in chunk]))
+        else:
+            known = set()
+        rows = []
+        for meta in chunk:
+            long, lat = _coordinate(meta)
+            rows.append((long, lat, _timestamp(meta),
+                         json.dumps(meta.get("tags", [])), json.dumps(meta),
+                         meta["pano_id"]))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO panorama (longitude, latitude,"
+                " timestamp, tags, meta, pano_id) VALUES (?, ?, ?, ?, ?, ?)",
+                rows)
+            self.conn.executemany(
+                "UPDATE panorama SET longitude = ?, latitude = ?,"
+                " timestamp = ?, tags = ?, meta = ? WHERE pano_id = ?", rows)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO panorama_rtree SELECT id, longitude,"
+                " longitude, latitude, latitude FROM panorama"
+                " WHERE pano_id = ?", [(row[-1],) for row in rows])
+        return [row[-1] for row in rows if row[-1] not in known]
+
+    def query_bbox(self, bbox, param=None):
+        """ Meta data of all panoramas within a bounding box.
+
+        Only the columnar meta data is loaded, the raw meta data is
+        retrieved from the database when it is needed.
+
+        Returns
+        -------
+        AdamMetaData:
+            Meta data of the panoramas, in insertion order.
+        """
+        rows = self.conn.execute(
+            "SELECT p.pano_id, p.longitude, p.latitude, p.timestamp, p.tags"
+            " FROM panorama_rtree AS r JOIN panorama AS p ON p.id = r.id"
+            " WHERE r.max_long >= ? AND r.min_long <= ?"
+            " AND r.max_lat >= ? AND r.min_lat <= ?"
+            # The R-tree stores rounded coordinates, so filter exactly too.
+            " AND p.longitude >= ? AND p.longitude <= ?"
+            " AND p.latitude >= ? AND p.latitude <= ? ORDER BY p.id",
+            2*(bbox[0][1], bbox[1][1], bbox[0][0], bbox[1][0])).fetchall()
+        pano_ids = [row[0] for row in rows]
+        return self.meta_class.from_columns(
+            param=param if param is not None else {},
+            pano_ids=pano_ids,
+            coordinates=[(row[1], row[2]) for row in rows],
+            timestamps=[row[3] for row in rows],
+            tags=[json.loads(row[4]) for row in rows],
+            meta_loader=lambda: self.records(pano_ids),
+        )
+
+    def records(self, pano_ids):
+        " Raw meta data {pano_id: meta} of panoramas. "
+        records = {}
+        for i_start in range(0, len(pano_ids), 500):
+            chunk = pano_ids[i_start:i_start+500]
+            rows = self.conn.execute(
+                "SELECT pano_id, meta FROM panorama WHERE pano_id IN"
+                " ({})".format(",".join("?"*len(chunk))), chunk).fetchall()
+            records.update({row[0]: json.loads(row[1]) for row in rows})
+        return {pano_id: records[pano_id] for pano_id in pano_ids
+                if pano_id in records}
+
+    def pano_meta(self, pano_id):
+        """ Meta data of a single panorama, in the per panorama format.
+
+        This is the same as AdamMetaData.to_file(pano_id=...) writes,
+        None if the panorama is unknown.
+        """
+        row = self.conn.execute(
+            "SELECT meta, longitude, latitude, timestamp,"
+            " (SELECT meta_timestamp FROM coverage ORDER BY id DESC LIMIT 1)"
+            " FROM panorama WHERE pano_id = ?",
+            (pano_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "name": self.meta_class.name,
+            "meta_timestamp": row[4],
+            "pano_timestamp": row[3],
+            "latitude": row[2],
+            "longitude": row[1],
+            "pano_id": pano_id,
+            "meta_data": json.loads(row[0]),
+        }
+
+    def close(self):
+        self.conn.close()
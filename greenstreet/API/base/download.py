@@ -0,0 +1,149 @@
+'''
+Concurrent downloading of pictures with pooled (keep-alive) connections.
+'''
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from greenstreet.API.base.fetch import FetchPolicy
+
+
+class Downloader():
+    """ Download files with a bounded pool of worker threads.
+
+    Every worker thread keeps its own requests.Session, so that connections
+    to the same host are reused between files instead of being opened for
+    every single picture.
+
+    Arguments
+    ---------
+    n_workers: int
+        Maximum number of files that are downloaded at the same time.
+    policy: FetchPolicy
+        Retry/backoff and rate limiting policy, default FetchPolicy().
+    store: PictureStore
+        If supplied, pictures are looked up in/added to this store, so that
+        they are only downloaded once.
+    """
+    def __init__(self, n_workers=16, policy=None, store=None):
+        self.n_workers = n_workers
+        if policy is None:
+            policy = FetchPolicy()
+        self.policy = policy
+        self.store = store
+        self._local = threading.local()
+        self._executor = None
+
+    @property
+    def session(self):
+        " Session of the current thread, created on first use. "
+        if getattr(self._local, "session", None) is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=self.n_workers, pool_maxsize=self.n_workers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._local.session = session
+        return self._local.session
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        return self._executor
+
+    def fetch(self, url, file_fp):
+        """ Download a single url to a file.
+
+        The file is first written to a temporary file and moved into place
+        afterwards, so that an interrupted download never leaves a partial
+        picture behind.
+
+        Returns
+        -------
+        bool:
+            True if the download was successful.
+        """
+        if self.store is not None:
+            object_fp = self.store.lookup(url)
+            if object_fp is None:
+                content = self.fetch_content(url)
+                if content is None:
+                    return False
+                object_fp = self.store.add(url, content)
+            self.store.link(object_fp, file_fp)
+            return True
+
+        content = self.fetch_content(url)
+        if content is None:
+            return False
+        tmp_fp = str(file_fp) + ".part"
+        with open(tmp_fp, "wb") as f:
+            f.write(content)
+        os.replace(tmp_fp, file_fp)
+        return True
+
+    def fetch_all_content(self, urls):
+        """ Download the content of many urls concurrently into memory.
+
+        Pictures that are in the store are read from there, but new
+        pictures are not added to the store.
+
+        Arguments
+        ---------
+        urls: dict
+            {key: url} for every url to download.
+
+        Returns
+        -------
+        dict:
+            {key: content}, where content is None if the download failed.
+        """
+        futures = {
+            key: self.executor.submit(self._stored_content, url)
+            for key, url in urls.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
+
+    def _stored_content(self, url):
+        if self.store is not None:
+            object_fp = self.store.lookup(url)
+            if object_fp is not None:
+                with open(object_fp, "rb") as f:
+                    return f.read()
+        return self.fetch_content(url)
+
+    def fetch_content(self, url):
+        " Download the content of an url, None if not successful. "
+        try:
+            response = self.policy.get(self.session, url, timeout=60)
+        except requests.RequestException:
+            return None
+        return response.content
+
+    def fetch_all(self, downloads):
+        """ Download many files concurrently.
+
+        Arguments
+        ---------
+        downloads: dict
+            {key: (url, file_fp)} for every file to download.
+
+        Returns
+        -------
+        dict:
+            {key: bool}, whether each of the downloads succeeded.
+        """
+        futures = {
+            key: self.executor.submit(self.fetch, url, file_fp)
+            for key, (url, file_fp) in downloads.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,195 @@
+'''
+Retry, backoff and rate limiting policy for HTTP requests.
+
+The same policy is used for retrieving meta data and for downloading
+pictures, so that all requests to a host within a process share a single
+rate limit.
+'''
+
+import random
+import threading
+from time import sleep, monotonic
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Rate limit of hosts for which no policy sets one.
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 20.0
+
+
+class TokenBucket():
+    """ Thread-safe token bucket rate limiter.
+
+    Arguments
+    ---------
+    rate: float
+        Number of tokens (requests) added per second.
+    capacity: float
+        Maximum number of tokens, i.e. the allowed burst size.
+    """
+    def __init__(self, rate=DEFAULT_RATE, capacity=DEFAULT_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def configure(self, rate, capacity):
+        " Change the rate and burst size of the bucket. "
+        with self.lock:
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+
+    def acquire(self):
+        " Wait until a token is available and take it. "
+        while True:
+            with self.lock:
+                now = monotonic()
+                if now >= self.blocked_until:
+                    self.tokens = min(
+                        self.capacity,
+                        self.tokens + (now - self.last)*self.rate)
+                    self.last = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens)/self.rate
+                else:
+                    wait = self.blocked_until - now
+            sleep(wait)
+
+    def pause(self, delay):
+        " Stop handing out tokens for some time (e.g. after a 429). "
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, monotonic() + delay)
+            self.tokens = 0
+            self.last = self.blocked_until
+
+
+_BUCKETS = {}
+_BUCKET_LOCK = threading.Lock()
+
+
+def host_bucket(host, rate=None, capacity=None):
+    """ Get the token bucket of a host, shared by all threads of the process.
+
+    If the rate or capacity is given, the bucket is (re)configured with
+    them, otherwise a new bucket gets DEFAULT_RATE and DEFAULT_BURST.
+    """
+    with _BUCKET_LOCK:
+        if host not in _BUCKETS:
+            _BUCKETS[host] = TokenBucket()
+        bucket = _BUCKETS[host]
+    if ((rate is not None and rate != bucket.rate)
+            or (capacity is not None and capacity != bucket.capacity)):
+        bucket.configure(bucket.rate if rate is None else rate,
+                         bucket.capacity if capacity is None else capacity)
+    return bucket
+
+
+class FetchPolicy():
+    """ Exponential backoff with jitter and per host rate limiting.
+
+    Arguments
+    ---------
+    n_try: int
+        Maximum number of attempts per request.
+    base_delay: float
+        Delay before the first retry in seconds, doubled for every retry.
+    max_delay: float
+        Maximum delay between attempts in seconds.
+    rate: float
+        Maximum number of requests per second to a single host, None:
+        keep the rate of the host (DEFAULT_RATE if not set before).
+    burst: float
+        Number of requests to a host that can be done in quick succession,
+        None: keep the burst size of the host (DEFAULT_BURST).
+    """
+    def __init__(self, n_try=5, base_delay=1.0, max_delay=60.0, rate=None,
+                 burst=None):
+        self.n_try = n_try
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate = rate
+        self.burst = burst
+
+    def backoff(self, i_try):
+        " Delay after the i_try'th failed attempt, with jitter. "
+        delay = min(self.max_delay, self.base_delay*2**i_try)
+        return random.uniform(delay/2, delay)
+
+    def get(self, session, url, **kwargs):
+        """ GET request with retries, following the policy.
+
+        Arguments
+        ---------
+        session: requests.Session
+            Session (or the requests module) to do the request with.
+        url: str
+            Url to retrieve.
+        kwargs:
+            Passed on to session.get.
+
+        Returns
+        -------
+        requests.Response:
+            Successful response.
+
+        Raises
+        ------
+        requests.RequestException:
+            If all attempts failed.
+        """
+        bucket = host_bucket(urlparse(url).netloc, self.rate, self.burst)
+        for i_try in range(self.n_try):
+            bucket.acquire()
+            last_try = (i_try == self.n_try - 1)
+            try:
+                response = session.get(url, **kwargs)
+            except requests.RequestException:
+                if last_try:
+                    raise
+                sleep(self.backoff(i_try))
+                continue
+
+            if response.status_code not in RETRY_STATUS:
+                response.raise_for_status()
+                return response
+            if last_try:
+                response.raise_for_status()
+
+            retry_after = _retry_after(response)
+            if retry_after is None:
+                delay = self.backoff(i_try)
+            else:
+                delay = retry_after
+            if response.status_code == 429 or retry_after is not None:
+                # The server is throttling us: stop all workers.
+                bucket.pause(min(delay, self.max_delay))
+            sleep(min(delay, self.max_delay))
+
+
+def _retry_after(response):
+    " Get the delay in seconds from the Retry-After header, if present. "
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_date.tzinfo is None:
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
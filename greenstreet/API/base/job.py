@@ -1,49 +1,212 @@
+import io
 import os
 from abc import ABC
 from os.path import join, isfile
+from pathlib import Path
 import json
 from json.decoder import JSONDecodeError
 
+import numpy as np
+
 from greenstreet.config import STATUS_OK, STATUS_FAIL
 from greenstreet.utils.size import b64_to_dict, dict_to_b64
+from greenstreet.utils.rle import RunLengthSegMap
+from greenstreet.API.base.download import Downloader
+from greenstreet.API.base.pack import open_pack, tile_pack_fp, batch_writes
 
 
 class GreenJob(ABC):
+    """ Download, segmentation and greenery computation of panoramas.
+
+    Arguments
+    ---------
+    seg_model: SegmentationBackend
+        Segmentation model.
+    green_model: BaseGreenery
+        Greenery model to compute class fractions.
+    downloader: Downloader
+        Downloader for the pictures.
+    meta_db: AdamMetaDatabase
+        Regional meta data, if None use the meta.json file of panoramas.
+    in_memory: bool
+        Keep downloaded pictures in memory and pass them to the
+        segmentation directly, instead of writing them to disk.
+    keep_pictures: bool
+        In memory mode, still write the pictures to disk after segmentation.
+    seg_pipeline: InferencePipeline
+        Pipeline for segmenting many pictures, decoding them in the
+        background while the model runs.
+    fused: bool
+        Compute the greenery fractions directly after the segmentation and
+        store only those, instead of the full segmentation maps.
+    qa_scale: int
+        In fused mode, also store the segmentation maps downsampled by this
+        factor, for quality assurance. None: do not store them.
+    seg_cache: SegmentationCache
+        Cache with segmentation results of pictures, which is consulted
+        before running the model. None: do not use a cache.
+    use_packs: bool
+        Store meta data, segmentations and greenery of panoramas as
+        records in the pack files of their tile, instead of in files in
+        the data directories of the panoramas.
+    """
     pic_type = "base"
 
-    def __init__(self, seg_model, green_model):
+    def __init__(self, seg_model, green_model, downloader=None, meta_db=None,
+                 in_memory=False, keep_pictures=False, seg_pipeline=None,
+                 fused=False, qa_scale=None, seg_cache=None,
+                 use_packs=False):
         self.seg_model = seg_model
         self.green_model = green_model
         self.name = "_".join([self.pic_type, self.seg_model.name,
                               self.green_model.name])
         self.seg_id = "_".join([self.pic_type, self.seg_model.name])
+        if downloader is None:
+            downloader = Downloader()
+        self.downloader = downloader
+        self.meta_db = meta_db
+        self.in_memory = in_memory
+        self.keep_pictures = keep_pictures
+        self._picture_buffer = {}
+        self.seg_pipeline = seg_pipeline
+        self.fused = fused and green_model is not None
+        self.qa_scale = check_qa_scale(qa_scale)
+        self.seg_cache = seg_cache
+        self.use_packs = use_packs
+
+    def download(self, data_dir):
+        return self.download_many([data_dir])[0]
+
+    def download_many(self, data_dirs):
+        """ Download the pictures of many panoramas at once.
+
+        All pictures (e.g. the faces of cubic panoramas) of all panoramas
+        are fetched concurrently by the downloader. Results of panoramas
+        with pictures that are only kept in memory have "in_memory" set,
+        since they have to be downloaded again for a later segmentation.
+        """
+        results = []
+        downloads = {}
+        for i_dir, data_dir in enumerate(data_dirs):
+            picture_dir = os.path.join(data_dir, "pictures")
+            if not self.in_memory or self.keep_pictures:
+                os.makedirs(picture_dir, exist_ok=True)
+            meta_data = self.pano_meta(data_dir)
+            if "status" in meta_data:
+                results.append(meta_data)
+                continue
+            for side, (url, pano_fp) in self._downloads(
+                    meta_data, picture_dir).items():
+                if not os.path.exists(pano_fp):
+                    downloads[(i_dir, side)] = (url, pano_fp)
+            results.append({
+                "status": STATUS_OK,
+                "data": {
+                    "latitude": meta_data["latitude"],
+                    "longitude": meta_data["longitude"],
+                    "timestamp": meta_data["pano_timestamp"],
+                }
+            })
+
+        if self.in_memory:
+            contents = self.downloader.fetch_all_content(
+                {key: url for key, (url, _) in downloads.items()})
+            success = {}
+            for (i_dir, side), content in contents.items():
+                success[(i_dir, side)] = content is not None
+                if content is not None:
+                    buffer = self._picture_buffer.setdefault(
+                        str(data_dirs[i_dir]), {})
+                    buffer[side] = content
+        else:
+            success = self.downloader.fetch_all(downloads)
+        for (i_dir, _), succeeded in success.items():
+            if not succeeded:
+                # The panorama is not segmented, so release the pictures
+                # of the faces that did succeed.
+                self._picture_buffer.pop(str(data_dirs[i_dir]), None)
+                results[i_dir] = {"status": STATUS_FAIL,
+                                  "msg": "Failed to retrieve panorama from"
+                                         " url."}
+        if self.in_memory and not self.keep_pictures:
+            for i_dir, _ in downloads:
+                if results[i_dir]["status"] == STATUS_OK:
+                    results[i_dir]["in_memory"] = True
+        return results
+
+    def pano_meta(self, data_dir):
+        """ Meta data of the panorama of a data directory.
+
+        The meta data is retrieved from the meta pack file of the tile
+        (with use_packs), the regional database if available, otherwise
+        from the meta.json file in the data directory.
+        If not found, return a dictionary with the failure status.
+        """
+        pano_id = _pano_id(data_dir)
+        if self.use_packs:
+            meta_data = self.pack(data_dir, "meta").get(pano_id)
+            if meta_data is not None:
+                return json.loads(meta_data)
+            if self.meta_db is None:
+                return {"status": STATUS_FAIL,
+                        "msg": f"Panorama '{pano_id}' not in meta pack"
+                               " file."}
+
+        if self.meta_db is not None:
+            meta_data = self.meta_db.pano_meta(pano_id)
+            if meta_data is None:
+                return {"status": STATUS_FAIL,
+                        "msg": f"Panorama '{pano_id}' not in database."}
+            return meta_data
 
-    def download(self, data_dir, n_try=5, timeout=3):
         meta_fp = os.path.join(data_dir, "meta.json")
-        picture_dir = os.path.join(data_dir, "pictures")
-        os.makedirs(picture_dir, exist_ok=True)
         try:
             with open(meta_fp, "r") as fp:
-                meta_data = json.load(fp)
+                return json.load(fp)
         except FileNotFoundError:
             return {"status": STATUS_FAIL,
                     "msg": f"File '{meta_fp}' not found."}
         except JSONDecodeError:
             return {"status": STATUS_FAIL,
                     "msg": f"File '{meta_fp}' unreadable (JSON Error)"}
-        ret = self._download(meta_data, picture_dir, n_try=n_try,
-                             timeout=timeout)
-        ret["data"] = {
-            "latitude": meta_data["latitude"],
-            "longitude": meta_data["longitude"],
-            "timestamp": meta_data["pano_timestamp"],
+
+    def _downloads(self, meta_data, picture_dir):
+        " Get the urls and destination files of all pictures to download. "
+        pano_urls = self.pano_urls(meta_data)
+        return {
+            side: (pano_urls[side], os.path.join(picture_dir, pano_file))
+            for side, pano_file in self.panorama_files().items()
         }
-        return ret
 
-    def segmentation(self, data_dir):
-        seg_fp = self.segmentation_file(data_dir)
+    def pictures(self, data_dir):
+        """ Pictures of a panorama for the segmentation.
+
+        Returns
+        -------
+        dict:
+            {side: picture}, where the picture is either the downloaded
+            content (in memory mode), or the file of the picture.
+        """
+        buffer = self._picture_buffer.get(str(data_dir), {})
+        return {
+            side: buffer.get(side, join(data_dir, "pictures", pano_file))
+            for side, pano_file in self.panorama_files().items()
+        }
+
+    def release_pictures(self, data_dir):
+        " Remove pictures from memory, writing them if keep_pictures. "
+        buffer = self._picture_buffer.pop(str(data_dir), {})
+        if not self.keep_pictures:
+            return
+        picture_dir = join(data_dir, "pictures")
+        for side, pano_file in self.panorama_files().items():
+            if side in buffer:
+                with open(join(picture_dir, pano_file), "wb") as f:
+                    f.write(buffer[side])
 
-        if isfile(seg_fp):
+    def segmentation(self, data_dir):
+        if self.segmentation_done(data_dir):
+            self.release_pictures(data_dir)
             return {"status": STATUS_OK}
 
         if self.seg_model is None:
@@ -51,22 +214,219 @@ class GreenJob(ABC):
                     "msg": "No valid segmentation model supplied."}
 
         try:
-            seg_res = self._segmentation(self.seg_model, data_dir)
+            seg_res = self._segmentation(data_dir)
         except FileNotFoundError:
             return {"status": STATUS_FAIL,
                     "msg": "Panorama(s) not found."}
+        finally:
+            self.release_pictures(data_dir)
+
+        return self._store_or_fail(seg_res, data_dir)
+
+    def segmentation_many(self, data_dirs, n_picture=32):
+        """ Segmentation of the pictures of many panoramas at once.
+
+        The pictures of (groups of) panoramas are segmented together, so
+        that the model can process them in batches, or they are streamed
+        through the segmentation pipeline.
+
+        Arguments
+        ---------
+        data_dirs: list
+            Data directories of the panoramas.
+        n_picture: int
+            Approximate number of pictures that are segmented together.
+        """
+        results = [None]*len(data_dirs)
+        todo = []
+        for i_dir, data_dir in enumerate(data_dirs):
+            if self.segmentation_done(data_dir):
+                self.release_pictures(data_dir)
+                results[i_dir] = {"status": STATUS_OK}
+                continue
+            if self.seg_model is None:
+                results[i_dir] = {"status": STATUS_FAIL,
+                                  "msg": "No valid segmentation model"
+                                         " supplied."}
+                continue
+            pictures = self.pictures(data_dir)
+            if any(isinstance(pic, (str, os.PathLike)) and not isfile(pic)
+                   for pic in pictures.values()):
+                self.release_pictures(data_dir)
+                results[i_dir] = {"status": STATUS_FAIL,
+                                  "msg": "Panorama(s) not found."}
+                continue
+            todo.append(i_dir)
+
+        for i_dir, seg_res in zip(todo, self._iter_segmentation(
+                [data_dirs[i_dir] for i_dir in todo], n_picture)):
+            results[i_dir] = self._store_or_fail(seg_res, data_dirs[i_dir])
+        return results
+
+    def _store_or_fail(self, seg_res, data_dir):
+        """ Store the segmentation of a panorama, if all pictures succeeded.
 
+        Pictures that could not be read or decoded have an exception
+        instead of a result, which fails the panorama (only).
+        """
+        for error in seg_res.values():
+            if isinstance(error, FileNotFoundError):
+                return {"status": STATUS_FAIL,
+                        "msg": "Panorama(s) not found."}
+            if isinstance(error, Exception):
+                return {"status": STATUS_FAIL,
+                        "msg": f"Picture could not be segmented: {error}"}
+        self.store_segmentation(seg_res, data_dir)
+        return {"status": STATUS_OK}
+
+    def _iter_segmentation(self, data_dirs, n_picture=32):
+        """ Segment the pictures of panoramas, one panorama at a time.
+
+        With a pipeline, all pictures are streamed through it at once,
+        otherwise groups of panoramas are passed to model.run_batch.
+        """
+        if self.seg_pipeline is not None:
+            groups = [data_dirs]
+        else:
+            n_group = max(1, n_picture//len(self.panorama_files()))
+            groups = [data_dirs[i_start:i_start+n_group]
+                      for i_start in range(0, len(data_dirs), n_group)]
+
+        for group in groups:
+            all_pictures = [self.pictures(data_dir) for data_dir in group]
+            pictures = [pic for pano_pictures in all_pictures
+                        for pic in pano_pictures.values()]
+            seg_iter = self._segment_pictures(pictures)
+            try:
+                for data_dir, pano_pictures in zip(group, all_pictures):
+                    seg_res = {side: next(seg_iter) for side in pano_pictures}
+                    self.release_pictures(data_dir)
+                    yield seg_res
+            finally:
+                for data_dir in group:
+                    self.release_pictures(data_dir)
+
+    def segmentation_done(self, data_dir):
+        """ Whether the segmentation of a panorama is stored already.
+
+        In fused mode the greenery file replaces the segmentation file.
+        """
+        if self.use_packs:
+            if self.fused and self._record_key(self.name, data_dir) in \
+                    self.pack(data_dir, "greenery"):
+                return True
+            return self._record_key(self.seg_id, data_dir) in \
+                self.pack(data_dir, "segmentation")
+        if self.fused and isfile(self.greenery_file(data_dir)):
+            return True
+        return isfile(self.find_segmentation_file(data_dir))
+
+    def store_segmentation(self, seg_res, data_dir):
+        """ Store the segmentation of a panorama.
+
+        In fused mode, the segmentation maps are reduced to greenery
+        fractions right away, which are stored instead.
+        """
+        if not self.fused:
+            self.write_segmentation(seg_res, data_dir)
+            return
+
+        self.save_greenery(self._greenery(seg_res, self.green_model),
+                           data_dir)
+        if self.qa_scale is not None:
+            self.write_segmentation(
+                downsample_segmentation(seg_res, self.qa_scale), data_dir,
+                qa=True)
+
+    def write_segmentation(self, seg_res, data_dir, qa=False):
+        """ Write the segmentation of a panorama to a file or pack file.
+
+        Arguments
+        ---------
+        seg_res: dict
+            {picture name: {"seg_map": np.array, "color_map": ...}}
+        data_dir: str
+            Data directory of the panorama.
+        qa: bool
+            Whether these are the downsampled maps for quality assurance.
+        """
+        if self.use_packs:
+            seg_id = self.seg_id + "_qa" if qa else self.seg_id
+            self.pack(data_dir, "segmentation").put(
+                self._record_key(seg_id, data_dir),
+                segmentation_to_bytes(seg_res, panorama_type=self.name,
+                                      segmentation_model=self.seg_model.name))
+            return
+        if qa:
+            seg_fp = self.qa_segmentation_file(data_dir)
+        else:
+            seg_fp = self.segmentation_file(data_dir)
         save_segmentation(seg_res, seg_fp, panorama_type=self.name,
                           segmentation_model=self.seg_model.name)
-        return {"status": STATUS_OK}
 
-    def greenery(self, data_dir):
-        seg_fp = self.segmentation_file(data_dir)
-        green_fp = self.greenery_file(data_dir)
+    def read_segmentation(self, data_dir, decode=True):
+        """ Read the segmentation of a panorama from a file or pack file.
+
+        With decode=False, seg maps may be run-length encoded (see
+        load_segmentation).
+
+        Returns
+        -------
+        tuple:
+            Segmentation results, panorama type and segmentation model.
+        """
+        if not self.use_packs:
+            return load_segmentation(self.find_segmentation_file(data_dir),
+                                     decode=decode)
+        data = self.pack(data_dir, "segmentation").get(
+            self._record_key(self.seg_id, data_dir))
+        if data is None:
+            raise FileNotFoundError(
+                f"Segmentation of {data_dir} not in pack file.")
+        return segmentation_from_bytes(data, decode=decode)
 
-        if isfile(green_fp):
-            with open(green_fp, "r") as f:
-                green_data = json.load(f)
+    def _segmentation(self, data_dir):
+        pictures = self.pictures(data_dir)
+        return dict(zip(pictures,
+                        self._segment_pictures(list(pictures.values()))))
+
+    def _segment_pictures(self, pictures):
+        """ Segment pictures, yielding the results in order.
+
+        Results are taken from the segmentation cache if possible, the
+        remaining pictures are segmented by the pipeline or the model.
+        For pictures that cannot be read or decoded, the exception is
+        yielded instead of a result.
+        """
+        if self.seg_cache is None:
+            keys = [None]*len(pictures)
+            cached = [None]*len(pictures)
+        else:
+            keys = [self.seg_cache.key(pic, self.seg_model.name,
+                                       self.seg_model.INPUT_SIZE)
+                    for pic in pictures]
+            cached = [self.seg_cache.lookup(key) for key in keys]
+
+        todo = [pic for pic, seg_res in zip(pictures, cached)
+                if seg_res is None]
+        if not len(todo):
+            seg_iter = iter([])
+        elif self.seg_pipeline is not None:
+            seg_iter = self.seg_pipeline.imap(todo, return_exceptions=True)
+        else:
+            seg_iter = iter(_run_batch(self.seg_model, todo))
+
+        for key, seg_res in zip(keys, cached):
+            if seg_res is None:
+                seg_res = next(seg_iter)
+                if (self.seg_cache is not None
+                        and not isinstance(seg_res, Exception)):
+                    self.seg_cache.add(key, seg_res)
+            yield seg_res
+
+    def greenery(self, data_dir):
+        green_data = self.read_greenery(data_dir)
+        if green_data is not None:
             return {"status": STATUS_OK,
                     "data": green_data["greenery_fractions"]}
 
@@ -74,7 +434,8 @@ class GreenJob(ABC):
             return {"status": STATUS_FAIL, "msg": "No valid greenery model."}
 
         try:
-            seg_res, pano_type, seg_model = load_segmentation(seg_fp)
+            seg_res, pano_type, seg_model = self.read_segmentation(
+                data_dir, decode=False)
             if pano_type != self.name:
                 return {"status": STATUS_FAIL,
                         "msg": "Panorama type that was loaded is wrong."}
@@ -83,22 +444,71 @@ class GreenJob(ABC):
                         "msg": "Wrong segmentation type that was loaded."}
         except FileNotFoundError:
             return {"status": STATUS_FAIL,
-                    "msg": f"Segmentation file {seg_fp} does not exist."}
+                    "msg": f"Segmentation of {data_dir} does not exist."}
 
         green_res = self._greenery(seg_res, self.green_model)
-        with open(green_fp, "w") as fp:
-            json.dump({
-                "greenery_fractions": green_res,
-                "segmentation_model": self.seg_model.name,
-                "greenery_model": self.green_model.name,
-                "panorama_type": self.pic_type,
-            }, fp, indent=4)
+        self.save_greenery(green_res, data_dir)
         return {"status": STATUS_OK, "data": green_res}
 
+    def read_greenery(self, data_dir):
+        " Stored greenery data of a panorama, None if not computed yet. "
+        if self.use_packs:
+            green_data = self.pack(data_dir, "greenery").get(
+                self._record_key(self.name, data_dir))
+            return None if green_data is None else json.loads(green_data)
+
+        green_fp = self.greenery_file(data_dir)
+        if not isfile(green_fp):
+            return None
+        with open(green_fp, "r") as f:
+            return json.load(f)
+
+    def save_greenery(self, green_res, data_dir):
+        green_data = {
+            "greenery_fractions": green_res,
+            "segmentation_model": self.seg_model.name,
+            "greenery_model": self.green_model.name,
+            "panorama_type": self.pic_type,
+        }
+        if self.use_packs:
+            self.pack(data_dir, "greenery").put(
+                self._record_key(self.name, data_dir),
+                json.dumps(green_data).encode())
+            return
+        with open(self.greenery_file(data_dir), "w") as fp:
+            json.dump(green_data, fp, indent=4)
+
+    def pack(self, data_dir, stage):
+        """ Pack file for a stage of the tile that a panorama belongs to.
+
+        Data directories of panoramas are <tile_dir>/pics/<pano_id>.
+        """
+        return open_pack(tile_pack_fp(Path(data_dir).parents[1], stage))
+
+    @staticmethod
+    def _record_key(result_id, data_dir):
+        return f"{result_id}/{_pano_id(data_dir)}"
+
     def segmentation_file(self, data_dir):
         seg_dir = join(data_dir, "segmentations")
         os.makedirs(seg_dir, exist_ok=True)
-        return join(data_dir, "segmentations", self.seg_id + ".json")
+        return join(data_dir, "segmentations", self.seg_id + ".npz")
+
+    def find_segmentation_file(self, data_dir):
+        """ Stored segmentation file, which might be in the JSON format.
+
+        Returns the (binary) segmentation file if neither exists.
+        """
+        seg_fp = self.segmentation_file(data_dir)
+        json_fp = os.path.splitext(seg_fp)[0] + ".json"
+        if not isfile(seg_fp) and isfile(json_fp):
+            return json_fp
+        return seg_fp
+
+    def qa_segmentation_file(self, data_dir):
+        seg_dir = join(data_dir, "segmentations")
+        os.makedirs(seg_dir, exist_ok=True)
+        return join(seg_dir, self.seg_id + "_qa.npz")
 
     def greenery_file(self, data_dir):
         green_dir = join(data_dir, "greenery")
@@ -119,6 +529,48 @@ class GreenJob(ABC):
                 return ret
         return ret
 
+    def execute_many(self, pipes):
+        """ Execute many pipelines stage by stage.
+
+        Downloads and segmentations of all pipelines in the same stage are
+        done together, so that the pictures of different panoramas are
+        fetched concurrently and segmented in batches. Records for pack
+        files are written together at the end.
+        """
+        with batch_writes():
+            return self._execute_many(pipes)
+
+    def _execute_many(self, pipes):
+        results = [[] for _ in pipes]
+        n_stage = max([len(pipe) for pipe in pipes], default=0)
+        many_programs = {
+            "download": self.download_many,
+            "segmentation": self.segmentation_many,
+        }
+        for i_stage in range(n_stage):
+            i_many = {program: [] for program in many_programs}
+            for i_pipe, pipe in enumerate(pipes):
+                if len(results[i_pipe]) != i_stage or i_stage >= len(pipe):
+                    continue
+                if pipe[i_stage]["program"] in many_programs:
+                    i_many[pipe[i_stage]["program"]].append(i_pipe)
+                else:
+                    results[i_pipe].append(self._execute(**pipe[i_stage]))
+
+            for program, i_pipes in i_many.items():
+                many_res = many_programs[program](
+                    [pipes[i_pipe][i_stage]["data_dir"] for i_pipe in i_pipes])
+                for i_pipe, res in zip(i_pipes, many_res):
+                    results[i_pipe].append(res)
+
+            for i_pipe, pipe in enumerate(pipes):
+                if (len(results[i_pipe]) == i_stage + 1
+                        and results[i_pipe][-1]["status"] == STATUS_FAIL):
+                    while len(results[i_pipe]) < len(pipe):
+                        results[i_pipe].append({"status": STATUS_FAIL,
+                                                "msg": "Broken pipeline."})
+        return results
+
     def _execute(self, data_dir, *args, program="download", **kwargs):
         if program == "download":
             return self.download(data_dir, *args, **kwargs)
@@ -129,7 +581,63 @@ class GreenJob(ABC):
         return {"status": STATUS_FAIL, "msg": f"program '{program}' unknown."}
 
 
+def check_qa_scale(qa_scale):
+    " Check that a qa_scale is None or a positive integer, and return it. "
+    if qa_scale is None:
+        return None
+    if (isinstance(qa_scale, bool)
+            or not isinstance(qa_scale, (int, np.integer)) or qa_scale < 1):
+        raise ValueError(f"qa_scale should be a positive integer, not"
+                         f" {qa_scale!r}.")
+    return int(qa_scale)
+
+
+def _run_batch(seg_model, pictures, batch_size=8):
+    """ Segment pictures with a model, like seg_model.run_batch.
+
+    Pictures that cannot be read or decoded get the exception instead of
+    a result, so that they do not fail the other pictures.
+    """
+    arrays = []
+    errors = {}
+    for i_picture, picture in enumerate(pictures):
+        try:
+            arrays.append(seg_model.preprocess(picture))
+        except Exception as e:
+            errors[i_picture] = e
+    seg_iter = iter([])
+    if len(arrays):
+        seg_iter = iter(seg_model.run_arrays(arrays, batch_size=batch_size))
+    return [errors[i_picture] if i_picture in errors else next(seg_iter)
+            for i_picture in range(len(pictures))]
+
+
+def _pano_id(data_dir):
+    return os.path.basename(os.path.normpath(data_dir))
+
+
 def save_segmentation(seg_res, segment_fp, panorama_type, segmentation_model):
+    """ Store the segmentation of the pictures of a panorama.
+
+    Files with the .npz extension are stored in the binary format, other
+    files in the (older) JSON format.
+
+    Arguments
+    ---------
+    seg_res: dict
+        {picture name: {"seg_map": np.array, "color_map": (names, colors)}}
+    segment_fp: str
+        File to store the segmentation in.
+    panorama_type: str
+        Name of the job that segmented the panorama.
+    segmentation_model: str
+        Name of the segmentation model.
+    """
+    if str(segment_fp).endswith(".npz"):
+        _save_segmentation_npz(seg_res, segment_fp, panorama_type,
+                               segmentation_model)
+        return
+
     zipped_seg_res = {"seg_res": {}}
     for image_name, image_seg in seg_res.items():
         zipped_seg_res["seg_res"][image_name] = dict_to_b64(image_seg)
@@ -140,6 +648,72 @@ def save_segmentation(seg_res, segment_fp, panorama_type, segmentation_model):
         json.dump(zipped_seg_res, f)
 
 
+def _save_segmentation_npz(seg_res, segment_fp, panorama_type,
+                           segmentation_model):
+    tmp_fp = str(segment_fp) + f".{os.getpid()}.part"
+    with open(tmp_fp, "wb") as f:
+        np.savez_compressed(f, **_segmentation_arrays(
+            seg_res, panorama_type, segmentation_model))
+    os.replace(tmp_fp, segment_fp)
+
+
+def segmentation_to_bytes(seg_res, panorama_type, segmentation_model):
+    " Segmentation of a panorama in the binary (npz) format. "
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **_segmentation_arrays(
+        seg_res, panorama_type, segmentation_model))
+    return buffer.getvalue()
+
+
+def segmentation_from_bytes(data, decode=True):
+    """ Inverse of segmentation_to_bytes.
+
+    Returns the same as load_segmentation.
+    """
+    return _load_segmentation_npz(io.BytesIO(data), decode=decode)
+
+
+def _segmentation_arrays(seg_res, panorama_type, segmentation_model):
+    """ Run-length encoded seg maps, with the color map only once.
+
+    Runs are stored as labels (uint8 if possible), lengths and the shape
+    of the map. All pictures of a panorama are segmented by the same
+    model, so they share the color map.
+    """
+    arrays = {
+        "panorama_type": np.array(panorama_type),
+        "segmentation_model": np.array(segmentation_model),
+        "image_names": np.array(list(seg_res)),
+    }
+    for i_image, image_seg in enumerate(seg_res.values()):
+        seg_map = np.asarray(image_seg["seg_map"])
+        if seg_map.size and seg_map.min() >= 0 and seg_map.max() < 256:
+            seg_map = seg_map.astype(np.uint8)
+        if seg_map.ndim == 2:
+            seg_runs = RunLengthSegMap.encode(seg_map)
+            length_type = np.uint16 if seg_map.shape[1] < 2**16 else np.int64
+            arrays[f"seg_labels_{i_image}"] = seg_runs.labels
+            arrays[f"seg_lengths_{i_image}"] = seg_runs.lengths.astype(
+                length_type)
+            arrays[f"seg_shape_{i_image}"] = np.array(seg_map.shape)
+        else:
+            arrays[f"seg_map_{i_image}"] = seg_map
+        if i_image == 0:
+            arrays["label_names"] = np.asarray(image_seg["color_map"][0])
+            arrays["label_colors"] = np.asarray(image_seg["color_map"][1])
+    return arrays
+
+
+def downsample_segmentation(seg_res, scale):
+    " Segmentation with the maps of all pictures downsampled by scale. "
+    return {
+        image_name: dict(image_seg,
+                         seg_map=np.asarray(image_seg["seg_map"])[::scale,
+                                                                   ::scale])
+        for image_name, image_seg in seg_res.items()
+    }
+
+
 def unzip_segmentation(zipped_segmentation):
     segmentation = {}
     for image_name, zsr in zipped_segmentation.items():
@@ -147,10 +721,53 @@ def unzip_segmentation(zipped_segmentation):
     return segmentation
 
 
-def load_segmentation(segment_fp):
+def load_segmentation(segment_fp, decode=True):
+    """ Load a segmentation file in the binary or JSON format.
+
+    Arguments
+    ---------
+    segment_fp: str
+        Segmentation file.
+    decode: bool
+        If False, run-length encoded seg maps are returned as a
+        RunLengthSegMap under "seg_runs" instead of under "seg_map", which
+        the greenery models can use directly.
+
+    Returns
+    -------
+    tuple:
+        Segmentation results, panorama type and segmentation model.
+    """
+    if str(segment_fp).endswith(".npz"):
+        return _load_segmentation_npz(segment_fp, decode=decode)
+
     with open(segment_fp, "r") as f:
         segmentation = json.load(f)
     seg_res = unzip_segmentation(segmentation["seg_res"])
     panorama_type = segmentation["panorama_type"]
     segmentation_model = segmentation["segmentation_model"]
     return seg_res, panorama_type, segmentation_model
+
+
+def _load_segmentation_npz(segment_fp, decode=True):
+    with np.load(segment_fp, allow_pickle=False) as data:
+        image_names = data["image_names"].tolist()
+        if len(image_names):
+            color_map = (data["label_names"], data["label_colors"])
+        seg_res = {}
+        for i_image, image_name in enumerate(image_names):
+            seg_res[image_name] = {"color_map": color_map}
+            if f"seg_map_{i_image}" in data:
+                seg_res[image_name]["seg_map"] = data[f"seg_map_{i_image}"]
+                continue
+            seg_runs = RunLengthSegMap(
+                data[f"seg_labels_{i_image}"],
+                data[f"seg_lengths_{i_image}"].astype(np.int64),
+                data[f"seg_shape_{i_image}"])
+            if decode:
+                seg_res[image_name]["seg_map"] = seg_runs.decode()
+            else:
+                seg_res[image_name]["seg_runs"] = seg_runs
+        panorama_type = str(data["panorama_type"])
+        segmentation_model = str(data["segmentation_model"])
+    return seg_res, panorama_type, segmentation_model
@@ -0,0 +1,289 @@
+'''
+Append-only pack files that store many small records (e.g. the results
+of all panoramas in a tile) in a single file with an index.
+'''
+
+import os
+import mmap
+import fcntl
+import struct
+import sqlite3
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+
+# Every record starts with a header, so that the index can be rebuilt
+# from the pack file itself.
+_HEADER = struct.Struct("<4sII")
+_MAGIC = b"GSPK"
+
+# Pack files with buffered records of the current thread, see batch_writes.
+_BATCH = threading.local()
+
+
+class PackFile():
+    """ Append-only file with records addressed by a key.
+
+    Records are appended to <pack_fp> and their offsets are stored in the
+    SQLite index <pack_fp>.db (in WAL mode). Writing a key again appends
+    a new version, compact removes old versions. Records are read through
+    a memory map of the pack file. Appends and compaction take a lock on
+    <pack_fp>.lock, so that multiple processes can share the pack file.
+    Within batch_writes, records are buffered and written together.
+
+    Arguments
+    ---------
+    pack_fp: str
+        Pack file; the directory is created if needed.
+    """
+    def __init__(self, pack_fp):
+        self.pack_fp = Path(pack_fp)
+        self.pack_fp.parent.mkdir(parents=True, exist_ok=True)
+        self.pack_fp.touch(exist_ok=True)
+        self.index_fp = Path(str(self.pack_fp) + ".db")
+        self.lock_fp = Path(str(self.pack_fp) + ".lock")
+        self._local = threading.local()
+        self._map_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._mmap = None
+        self._map_id = None
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS record ("
+                " key TEXT PRIMARY KEY, offset INTEGER NOT NULL,"
+                " size INTEGER NOT NULL)")
+
+    @property
+    def conn(self):
+        " Connection to the index, one per thread. "
+        if getattr(self._local, "conn", None) is None:
+            self._local.conn = sqlite3.connect(str(self.index_fp),
+                                               timeout=60)
+            self._local.conn.execute("PRAGMA journal_mode=WAL")
+        return self._local.conn
+
+    @contextmanager
+    def _locked(self):
+        " Exclusive lock for appending to or rewriting the pack file. "
+        with open(self.lock_fp, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __contains__(self, key):
+        with self._pending_lock:
+            if key in self._pending:
+                return True
+        return self.conn.execute("SELECT 1 FROM record WHERE key = ?",
+                                 (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM record").fetchone()[0]
+
+    def keys(self):
+        return [row[0] for row in self.conn.execute(
+            "SELECT key FROM record ORDER BY offset")]
+
+    def put(self, key, data):
+        """ Append a record, replacing earlier versions of the key.
+
+        Within batch_writes, the record is only written at the end of it.
+        """
+        batch = getattr(_BATCH, "packs", None)
+        if batch is None:
+            self.put_many([(key, data)])
+            return
+        with self._pending_lock:
+            self._pending[key] = data
+        batch[self] = True
+
+    def put_many(self, records):
+        """ Append records with a single lock and index transaction.
+
+        Arguments
+        ---------
+        records: iterable
+            (key, data) of every record.
+        """
+        rows = []
+        with self._locked(), open(self.pack_fp, "ab") as f:
+            f.seek(0, os.SEEK_END)
+            for key, data in records:
+                key_bytes = key.encode()
+                f.write(_HEADER.pack(_MAGIC, len(key_bytes), len(data)))
+                f.write(key_bytes)
+                rows.append((key, f.tell(), len(data)))
+                f.write(data)
+            f.flush()
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO record (key, offset, size)"
+                    " VALUES (?, ?, ?)", rows)
+
+    def flush(self):
+        " Write the records that are buffered by batch_writes. "
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if len(pending):
+            self.put_many(pending.items())
+
+    def delete(self, key):
+        " Remove a record from the index, its data is removed by compact. "
+        with self._pending_lock:
+            self._pending.pop(key, None)
+        with self.conn:
+            self.conn.execute("DELETE FROM record WHERE key = ?", (key,))
+
+    def get(self, key):
+        " Data of a record, None if the key is not in the pack. "
+        with self._pending_lock:
+            if key in self._pending:
+                return self._pending[key]
+        row = self.conn.execute(
+            "SELECT offset, size FROM record WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        offset, size = row
+        with self._map_lock:
+            pack_map = self._map(offset + size)
+            return bytes(pack_map[offset:offset+size])
+
+    def _map(self, end):
+        " Memory map of the pack file that covers at least [0, end). "
+        stat = os.stat(self.pack_fp)
+        map_id = (stat.st_ino, stat.st_dev)
+        if (self._mmap is None or self._map_id != map_id
+                or len(self._mmap) < end):
+            if self._mmap is not None:
+                self._mmap.close()
+            with open(self.pack_fp, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_id = map_id
+        return self._mmap
+
+    def compact(self):
+        """ Rewrite the pack file with only the current records.
+
+        Returns
+        -------
+        tuple:
+            Size of the pack file (bytes) before and after compaction.
+        """
+        self.flush()
+        tmp_fp = Path(str(self.pack_fp) + f".{os.getpid()}.part")
+        # The lock is on a separate file, since the pack file is replaced.
+        with self._locked():
+            old_size = os.path.getsize(self.pack_fp)
+            new_offsets = []
+            with open(tmp_fp, "wb") as f:
+                for key in self.keys():
+                    data = self.get(key)
+                    key_bytes = key.encode()
+                    f.write(_HEADER.pack(_MAGIC, len(key_bytes), len(data)))
+                    f.write(key_bytes)
+                    new_offsets.append((f.tell(), key))
+                    f.write(data)
+            os.replace(tmp_fp, self.pack_fp)
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE record SET offset = ? WHERE key = ?",
+                    new_offsets)
+            new_size = os.path.getsize(self.pack_fp)
+        return old_size, new_size
+
+    def rebuild_index(self):
+        " Recreate the index from the record headers in the pack file. "
+        records = {}
+        with open(self.pack_fp, "rb") as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                magic, key_len, size = _HEADER.unpack(header)
+                if magic != _MAGIC:
+                    raise ValueError(f"Corrupt pack file {self.pack_fp}")
+                key = f.read(key_len).decode()
+                records[key] = (f.tell(), size)
+                f.seek(size, os.SEEK_CUR)
+        with self.conn:
+            self.conn.execute("DELETE FROM record")
+            self.conn.executemany(
+                "INSERT INTO record (key, offset, size) VALUES (?, ?, ?)",
+                [(key, offset, size)
+                 for key, (offset, size) in records.items()])
+
+    def close(self):
+        self.flush()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if getattr(self._local, "conn", None) is not None:
+            self._local.conn.close()
+            self._local.conn = None
+
+
+_OPEN_PACKS = {}
+_OPEN_LOCK = threading.Lock()
+
+
+def open_pack(pack_fp):
+    " Pack file object, shared by all users within the process. "
+    pack_fp = Path(pack_fp).resolve()
+    with _OPEN_LOCK:
+        if pack_fp not in _OPEN_PACKS:
+            _OPEN_PACKS[pack_fp] = PackFile(pack_fp)
+        return _OPEN_PACKS[pack_fp]
+
+
+@contextmanager
+def batch_writes():
+    """ Buffer the records that this thread puts into pack files.
+
+    At the end, the buffered records of every pack file are written with
+    one lock and one index transaction (see PackFile.put_many), instead of
+    one per record. Buffered records can be read before that.
+    """
+    if getattr(_BATCH, "packs", None) is not None:
+        yield
+        return
+    _BATCH.packs = {}
+    try:
+        yield
+    finally:
+        packs, _BATCH.packs = _BATCH.packs, None
+        for pack in packs:
+            pack.flush()
+
+
+def tile_pack_fp(tile_dir, stage):
+    """ Pack file of a tile for one stage.
+
+    Arguments
+    ---------
+    tile_dir: str
+        Directory of the tile.
+    stage: str
+        Stage of the pipeline, e.g. "meta", "segmentation" or "greenery".
+    """
+    return Path(tile_dir, "packs", f"{stage}.pack")
+
+
+def compact_packs(data_dir):
+    """ Compact all pack files in a directory (recursively).
+
+    Returns
+    -------
+    tuple:
+        Total size of the pack files (bytes) before and after compaction.
+    """
+    total_old, total_new = 0, 0
+    for pack_fp in sorted(Path(data_dir).glob("**/*.pack")):
+        old_size, new_size = open_pack(pack_fp).compact()
+        total_old += old_size
+        total_new += new_size
+    return total_old, total_new
@@ -0,0 +1,97 @@
+'''
+Content addressed store for downloaded pictures, shared by all data
+directories on a node.
+'''
+
+import os
+import shutil
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+from greenstreet.config import CACHE_DIR
+
+
+class PictureStore():
+    """ Store pictures once, keyed by their url and content hash.
+
+    Pictures are stored as objects/<ab>/<sha256>.jpg, and an index maps
+    urls to content hashes. Data directories reference the objects
+    through hard links (or copies if linking is not possible), so the
+    same picture is downloaded and stored only once across all bounding
+    boxes, grid levels and runs.
+
+    Arguments
+    ---------
+    store_dir: str
+        Directory of the store, default: <CACHE_DIR>/pictures.
+    """
+    def __init__(self, store_dir=None):
+        if store_dir is None:
+            store_dir = Path(CACHE_DIR, "pictures")
+        self.store_dir = Path(store_dir)
+        self.object_dir = Path(self.store_dir, "objects")
+        self.object_dir.mkdir(parents=True, exist_ok=True)
+        self.index_fp = Path(self.store_dir, "index.db")
+        self._local = threading.local()
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS picture ("
+                " url TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+
+    @property
+    def conn(self):
+        " Connection to the index, one per thread. "
+        if getattr(self._local, "conn", None) is None:
+            self._local.conn = sqlite3.connect(str(self.index_fp),
+                                               timeout=60)
+        return self._local.conn
+
+    def object_fp(self, digest):
+        return Path(self.object_dir, digest[:2], digest + ".jpg")
+
+    def lookup(self, url):
+        " File of the picture of an url, None if it is not in the store. "
+        row = self.conn.execute("SELECT digest FROM picture WHERE url = ?",
+                                (url,)).fetchone()
+        if row is None:
+            return None
+        object_fp = self.object_fp(row[0])
+        if not object_fp.exists():
+            return None
+        return object_fp
+
+    def add(self, url, content):
+        """ Add the content of an url to the store.
+
+        Returns
+        -------
+        Path:
+            File of the stored object.
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        object_fp = self.object_fp(digest)
+        if not object_fp.exists():
+            object_fp.parent.mkdir(exist_ok=True)
+            tmp_fp = Path(str(object_fp) + f".{os.getpid()}"
+                          f".{threading.get_ident()}.part")
+            with open(tmp_fp, "wb") as f:
+                f.write(content)
+            os.replace(tmp_fp, object_fp)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO picture (url, digest) VALUES (?, ?)",
+                (url, digest))
+        return object_fp
+
+    def link(self, object_fp, file_fp):
+        " Make a picture from the store available at file_fp. "
+        tmp_fp = str(file_fp) + ".part"
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+        try:
+            os.link(object_fp, tmp_fp)
+        except OSError:
+            shutil.copyfile(object_fp, tmp_fp)
+        os.replace(tmp_fp, file_fp)
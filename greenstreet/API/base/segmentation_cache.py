@@ -0,0 +1,158 @@
+'''
+Cache of segmentation results, shared by all data directories on a node.
+'''
+
+import os
+import sqlite3
+import hashlib
+import threading
+from time import time
+from pathlib import Path
+
+import numpy as np
+
+from greenstreet.config import CACHE_DIR
+
+
+class SegmentationCache():
+    """ Segmentation results keyed by image content, model and input size.
+
+    The same picture can be part of many data directories (bounding boxes,
+    grid levels, runs), and is then only segmented once. Results are
+    stored as objects/<ab>/<key>.npz; the total size of the objects is
+    bounded by evicting the least recently used results.
+
+    Arguments
+    ---------
+    cache_dir: str
+        Directory of the cache, default: <CACHE_DIR>/segmentations.
+    max_size: int
+        Maximum total size of the cached results in bytes.
+    """
+    def __init__(self, cache_dir=None, max_size=2*1024**3):
+        if cache_dir is None:
+            cache_dir = Path(CACHE_DIR, "segmentations")
+        self.cache_dir = Path(cache_dir)
+        self.object_dir = Path(self.cache_dir, "objects")
+        self.object_dir.mkdir(parents=True, exist_ok=True)
+        self.index_fp = Path(self.cache_dir, "index.db")
+        self.max_size = max_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset_stats()
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS segmentation ("
+                " key TEXT PRIMARY KEY, size INTEGER NOT NULL,"
+                " last_used REAL NOT NULL)")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS segmentation_last_used"
+                " ON segmentation (last_used)")
+
+    @property
+    def conn(self):
+        " Connection to the index, one per thread. "
+        if getattr(self._local, "conn", None) is None:
+            self._local.conn = sqlite3.connect(str(self.index_fp),
+                                               timeout=60)
+        return self._local.conn
+
+    def reset_stats(self):
+        self.stats = {"n_hit": 0, "n_miss": 0, "n_evict": 0}
+
+    def report(self):
+        n_lookup = max(1, self.stats["n_hit"] + self.stats["n_miss"])
+        return (
+            f"Segmentation cache: {self.stats['n_hit']} hits,"
+            f" {self.stats['n_miss']} misses"
+            f" ({100*self.stats['n_hit']/n_lookup:.1f}% hit rate),"
+            f" {self.stats['n_evict']} evicted"
+        )
+
+    @staticmethod
+    def key(picture, model_name, input_size):
+        """ Cache key of the segmentation of a picture.
+
+        Arguments
+        ---------
+        picture: str or bytes
+            File or (JPEG) content of the picture.
+        model_name: str
+            Name of the segmentation model.
+        input_size: int
+            Input size of the model.
+        """
+        if not isinstance(picture, (bytes, bytearray)):
+            with open(picture, "rb") as f:
+                picture = f.read()
+        digest = hashlib.sha256(picture)
+        digest.update(f"\0{model_name}\0{input_size}".encode())
+        return digest.hexdigest()
+
+    def object_fp(self, key):
+        return Path(self.object_dir, key[:2], key + ".npz")
+
+    def lookup(self, key):
+        " Cached segmentation result, None if it is not in the cache. "
+        try:
+            with np.load(self.object_fp(key), allow_pickle=False) as data:
+                seg_res = {
+                    "seg_map": data["seg_map"].astype(np.int64),
+                    "color_map": (data["label_names"], data["label_colors"]),
+                }
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            with self._lock:
+                self.stats["n_miss"] += 1
+            return None
+        with self.conn:
+            self.conn.execute(
+                "UPDATE segmentation SET last_used = ? WHERE key = ?",
+                (time(), key))
+        with self._lock:
+            self.stats["n_hit"] += 1
+        return seg_res
+
+    def add(self, key, seg_res):
+        " Store a segmentation result, evicting old results if needed. "
+        seg_map = np.asarray(seg_res["seg_map"])
+        if seg_map.size and seg_map.min() >= 0 and seg_map.max() < 256:
+            seg_map = seg_map.astype(np.uint8)
+        object_fp = self.object_fp(key)
+        object_fp.parent.mkdir(exist_ok=True)
+        tmp_fp = Path(str(object_fp) + f".{os.getpid()}"
+                      f".{threading.get_ident()}.part")
+        with open(tmp_fp, "wb") as f:
+            np.savez_compressed(
+                f, seg_map=seg_map,
+                label_names=np.asarray(seg_res["color_map"][0]),
+                label_colors=np.asarray(seg_res["color_map"][1]))
+        os.replace(tmp_fp, object_fp)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO segmentation (key, size, last_used)"
+                " VALUES (?, ?, ?)", (key, object_fp.stat().st_size, time()))
+        self.evict()
+
+    def evict(self):
+        " Remove the least recently used results until the cache fits. "
+        total_size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM segmentation").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        rows = self.conn.execute(
+            "SELECT key, size FROM segmentation ORDER BY last_used").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(self.object_fp(key))
+            except FileNotFoundError:
+                pass
+            evicted.append((key,))
+            total_size -= size
+        with self.conn:
+            self.conn.executemany("DELETE FROM segmentation WHERE key = ?",
+                                  evicted)
+        with self._lock:
+            self.stats["n_evict"] += len(evicted)
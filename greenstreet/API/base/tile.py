@@ -3,6 +3,7 @@ from pathlib import Path
 from greenstreet.API.adam.meta import AdamMetaData
 from json.decoder import JSONDecodeError
 from greenstreet.config import STATUS_FAIL
+from greenstreet.API.base.pack import open_pack, tile_pack_fp, compact_packs
 
 
 DOWNLOAD_SUCCESS = 0
@@ -10,7 +11,8 @@ DOWNLOAD_FAIL = 1
 
 
 class Tile():
-    def __init__(self, tile_name, bbox, tile_dir, meta_class=AdamMetaData):
+    def __init__(self, tile_name, bbox, tile_dir, meta_class=AdamMetaData,
+                 meta_db=None, use_packs=False):
         self.tile_name = tile_name
         self.tile_dir = tile_dir
         self.bbox = bbox
@@ -19,6 +21,8 @@ class Tile():
         self.query_dir = Path(tile_dir, "queries")
         self.meta_fp = Path(tile_dir, "meta.json")
         self.meta_class = meta_class
+        self.meta_db = meta_db
+        self.use_packs = use_packs
         self._tile_data = None
         self._meta_data = None
         self._result_data = None
@@ -62,17 +66,48 @@ class Tile():
         return jobs
 
     def prepare(self, jobs):
+        # With a regional database, the meta data is retrieved from there,
+        # unless it is stored in the pack file of the tile.
+        if self.meta_db is not None and not self.use_packs:
+            return
+
         pano_ids = []
         for pano_id, pipe in jobs.items():
             if pipe[0]["program"] == "download":
                 pano_ids.append(pano_id)
 
         meta_data = self.meta_data
+        if self.use_packs:
+            # Store the same records that the database would return.
+            if self.meta_db is not None:
+                pano_meta = self.meta_db.pano_meta
+            else:
+                pano_meta = meta_data.pano_meta
+            meta_pack = self.pack("meta")
+            meta_pack.put_many(
+                (pano_id, json.dumps(pano_meta(pano_id)).encode())
+                for pano_id in pano_ids if pano_id not in meta_pack)
+            return
+
         for pano_id in pano_ids:
             pano_dir = _data_dir(self.tile_dir, pano_id)
             pano_dir.mkdir(exist_ok=True, parents=True)
             meta_data.to_file(Path(pano_dir, "meta.json"), pano_id=pano_id)
 
+    def pack(self, stage):
+        " Pack file of the tile for a stage, e.g. 'meta'. "
+        return open_pack(tile_pack_fp(self.tile_dir, stage))
+
+    def compact_packs(self):
+        """ Remove old versions of records from the pack files of the tile.
+
+        Returns
+        -------
+        tuple:
+            Total size of the pack files (bytes) before and after.
+        """
+        return compact_packs(Path(self.tile_dir, "packs"))
+
     def submit_result(self, jobs, results, job_runner, query=None):
         tile_data = self.tile_data
         result_data = self.result_data
@@ -128,6 +163,37 @@ class Tile():
                 pass
         return results
 
+    def refresh_meta(self):
+        """ Update the meta data of the tile with newer panoramas.
+
+        Only for tiles without a regional database, for those use
+        TileManager.refresh_meta.
+
+        Returns
+        -------
+        list:
+            Pano ids of the new panoramas.
+        """
+        new_ids = self.meta_data.update()
+        if len(new_ids):
+            self.meta_data.to_file(self.meta_fp)
+            self.reset_queries()
+        return new_ids
+
+    def reset_queries(self):
+        """ Forget sampled panoramas and collected results.
+
+        Results of individual panoramas (download, segmentation, greenery)
+        are kept, but sampling is redone with the current meta data.
+        """
+        if self.meta_db is not None:
+            self._meta_data = None
+        if self.query_dir.exists():
+            for query_fp in self.query_dir.glob("*.json"):
+                query_fp.unlink()
+        self._result_data = _new_result_data()
+        self.save()
+
     def save(self):
         if self._result_data is not None:
             with open(self.result_fp, "w") as f:
@@ -154,13 +220,26 @@ class Tile():
 
     @property
     def meta_data(self):
+        if self._meta_data is None and self.meta_db is not None:
+            if not self.meta_db.covers(self.bbox):
+                # Use the meta data file of the tile if it exists already.
+                if self.meta_fp.exists():
+                    self.meta_db.import_file(self.bbox, self.param,
+                                             self.meta_fp)
+                else:
+                    self.meta_db.download(self.bbox, self.param)
+            self._meta_data = self.meta_db.query_bbox(
+                self.bbox, param=self.param)
         if self._meta_data is None:
             try:
-                self._meta_data = self.meta_class.from_file(self.meta_fp)
+                self._meta_data = self.meta_class.from_file(
+                    self.meta_fp, columnar=True)
             except FileNotFoundError:
-                self._meta_data = self.meta_class.from_download(self.param)
                 Path(self.tile_dir).mkdir(parents=True, exist_ok=True)
-                self._meta_data.to_file(self.meta_fp)
+                self.meta_class.download_to_file(self.param, self.meta_fp,
+                                                 columnar=True)
+                self._meta_data = self.meta_class.from_file(
+                    self.meta_fp, columnar=True)
         return self._meta_data
 
     @property
@@ -205,13 +284,14 @@ def add_jobs(pano_id, tile_data, job_runner, job_type, jobs, data_dir):
 
     try:
         down_res = tile_data["download"][job_runner.pic_type][pano_id]
-        if down_res["status"] == DOWNLOAD_FAIL:
-            return
-        if len(new_jobs):
-            new_jobs.reverse()
-            jobs[pano_id] = new_jobs
-        return
     except KeyError:
+        down_res = None
+    if down_res is not None and down_res["status"] == DOWNLOAD_FAIL:
+        return
+    # Pictures that were only downloaded into memory are not available
+    # anymore, so they are downloaded again if they need to be segmented.
+    needs_pictures = any(job["program"] == "segmentation" for job in new_jobs)
+    if down_res is None or (down_res.get("in_memory") and needs_pictures):
         new_jobs.append({
             "data_dir": data_dir,
             "program": "download",
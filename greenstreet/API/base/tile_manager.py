@@ -6,15 +6,21 @@ from configparser import ConfigParser
 from tqdm import tqdm
 import numpy as np
 
-from greenstreet.greenery.kriging import krige_greenery
 from greenstreet.utils.mapping import compute_alpha
 from greenstreet.utils import _extend_green_res
 from greenstreet.utils.selection import select_bbox, get_segmentation_model,\
     get_green_model, get_job_runner
 from greenstreet.query import GridQuery
 from greenstreet.greenery.measure import LinearMeasure
-from greenstreet.greenery.semivariogram import _semivariance
 from greenstreet.API.base.tile import Tile
+from greenstreet.API.base.download import Downloader
+from greenstreet.API.base.fetch import FetchPolicy
+from greenstreet.API.base.job import check_qa_scale
+from greenstreet.API.base.picture_store import PictureStore
+from greenstreet.API.base.segmentation_cache import SegmentationCache
+from greenstreet.models.pipeline import InferencePipeline
+from greenstreet.models.pool import SegmentationPool
+from greenstreet.API.adam.meta_db import AdamMetaDatabase
 
 
 class TileManager(object):
@@ -24,8 +30,27 @@ class TileManager(object):
                  green_weights={'vegetation': 1},
                  use_panorama=False,
                  use_weighting=True,
+                 n_download=16,
+                 download_rate=None,
+                 download_burst=None,
+                 chunk_size=256,
+                 use_picture_store=False,
+                 picture_store_dir=None,
+                 in_memory=False,
+                 keep_pictures=False,
+                 n_decoder=2,
+                 seg_kwargs={},
+                 fused=False,
+                 qa_scale=None,
+                 n_seg_workers=0,
+                 use_seg_cache=False,
+                 seg_cache_dir=None,
+                 seg_cache_size=2*1024**3,
+                 use_packs=False,
+                 persist_weights=False,
                  ):
 
+        check_qa_scale(qa_scale)
         self.data_dir = data_dir
         self.bbox_str = bbox_str
         bbox = select_bbox(bbox_str)
@@ -35,6 +60,7 @@ class TileManager(object):
         self.cache_dir = os.path.join(data_dir, "cache")
         self.krige_dir = os.path.join(data_dir, "krige")
         self.db_fp = os.path.join(data_dir, "results.db")
+        self.meta_db_fp = os.path.join(data_dir, "meta.db")
         self.lock_fp = os.path.join(self.cache_dir, "lock.db")
 #         self.empty_fp = os.path.join(self.cache_dir, "empty_tiles.json")
 #         self.empty_files = load_empty_list(self.empty_fp, self.lock_fp)
@@ -46,13 +72,53 @@ class TileManager(object):
         self.use_weighting = use_weighting
         self.measure_name = "linear"
         self.seg_model_name = seg_model_name
-
-        self.seg_model = get_segmentation_model(seg_model_name)
-        self.green_model = get_green_model(use_panorama, use_weighting)
+        self.chunk_size = chunk_size
+        self.use_packs = use_packs
+
+        if n_seg_workers > 0:
+            self.seg_model = SegmentationPool(
+                seg_model_name, n_worker=n_seg_workers,
+                model_kwargs=seg_kwargs)
+            batch_size = self.seg_model.batch_size*n_seg_workers
+        else:
+            self.seg_model = get_segmentation_model(
+                seg_model_name, lazy=True, **seg_kwargs)
+            batch_size = 8
+        self.green_model = get_green_model(use_panorama, use_weighting,
+                                           persist_weights=persist_weights)
+        if n_decoder > 0:
+            self.seg_pipeline = InferencePipeline(
+                self.seg_model, n_decoder=n_decoder, batch_size=batch_size,
+                queue_size=max(16, 2*batch_size))
+        else:
+            self.seg_pipeline = None
+        if use_seg_cache:
+            self.seg_cache = SegmentationCache(seg_cache_dir,
+                                               max_size=seg_cache_size)
+        else:
+            self.seg_cache = None
+        if use_picture_store:
+            store = PictureStore(picture_store_dir)
+        else:
+            store = None
+        self.downloader = Downloader(
+            n_workers=n_download, store=store,
+            policy=FetchPolicy(rate=download_rate, burst=download_burst))
+        os.makedirs(data_dir, exist_ok=True)
+        self.meta_db = AdamMetaDatabase(self.meta_db_fp)
         self.job_runner = get_job_runner(
             use_panorama=use_panorama,
             seg_model=self.seg_model,
-            green_model=self.green_model)
+            green_model=self.green_model,
+            downloader=self.downloader,
+            meta_db=self.meta_db,
+            in_memory=in_memory,
+            keep_pictures=keep_pictures,
+            seg_pipeline=self.seg_pipeline,
+            fused=fused,
+            qa_scale=qa_scale,
+            seg_cache=self.seg_cache,
+            use_packs=use_packs)
 
         self.initialize_tiles()
 
@@ -94,10 +160,52 @@ class TileManager(object):
             tile_data["tile"] = Tile(
                 tile_name, tile_data["bbox"],
                 Path(self.tiles_dir, tile_name),
+                meta_db=self.meta_db,
+                use_packs=self.use_packs,
             )
             tile_data["query"] = GridQuery(
                 bbox=tile_data["bbox"], grid_level=self.grid_level)
 
+    def refresh_meta(self):
+        """ Retrieve panoramas newer than the stored meta data.
+
+        Tiles with new panoramas get their panoramas resampled, the other
+        tiles are left untouched.
+
+        Returns
+        -------
+        dict:
+            {tile_name: [pano_id, ...]} for all tiles with new panoramas.
+        """
+        new_ids = set(self.meta_db.refresh())
+        changed_tiles = {}
+        if not len(new_ids):
+            return changed_tiles
+        for tile_name, tile_data in self.tile_list.items():
+            tile = tile_data["tile"]
+            tile_ids = self.meta_db.query_bbox(tile.bbox).pano_ids.tolist()
+            tile_new_ids = [pano_id for pano_id in tile_ids
+                            if pano_id in new_ids]
+            if len(tile_new_ids):
+                tile.reset_queries()
+                changed_tiles[tile_name] = tile_new_ids
+        return changed_tiles
+
+    def compact_packs(self):
+        """ Compact the pack files of all tiles.
+
+        Returns
+        -------
+        tuple:
+            Total size of the pack files (bytes) before and after.
+        """
+        total_old, total_new = 0, 0
+        for tile_data in self.tile_list.values():
+            old_size, new_size = tile_data["tile"].compact_packs()
+            total_old += old_size
+            total_new += new_size
+        return total_old, total_new
+
     def get_jobs(self, job_type="greenery"):
         all_jobs = {}
         for tile_name, tile_data in self.tile_list.items():
@@ -114,14 +222,30 @@ class TileManager(object):
             tile = self.tile_list[tile_name]["tile"]
             tile.prepare(job_list)
 
-        n_jobs = np.sum([len(x) for x in jobs.values()])
-        pbar = tqdm(total=n_jobs)
-        for tile_name, job_list in jobs.items():
-            results[tile_name] = {}
-            for pano_id, job in job_list.items():
-                results[tile_name][pano_id] = self.job_runner.execute(job)
-                pbar.update(1)
+        # Pipelines are executed in chunks, so that the downloads within a
+        # chunk can be done concurrently.
+        all_pipes = [(tile_name, pano_id, pipe)
+                     for tile_name, job_list in jobs.items()
+                     for pano_id, pipe in job_list.items()]
+        pbar = tqdm(total=len(all_pipes))
+        for i_start in range(0, len(all_pipes), self.chunk_size):
+            chunk = all_pipes[i_start:i_start+self.chunk_size]
+            chunk_results = self.job_runner.execute_many(
+                [pipe for _, _, pipe in chunk])
+            for (tile_name, pano_id, _), res in zip(chunk, chunk_results):
+                if tile_name not in results:
+                    results[tile_name] = {}
+                results[tile_name][pano_id] = res
+            pbar.update(len(chunk))
         pbar.close()
+        if (self.seg_pipeline is not None
+                and self.seg_pipeline.stats["n_image"]):
+            print(self.seg_pipeline.report())
+            self.seg_pipeline.reset_stats()
+        if self.seg_cache is not None and (self.seg_cache.stats["n_hit"]
+                                           + self.seg_cache.stats["n_miss"]):
+            print(self.seg_cache.report())
+            self.seg_cache.reset_stats()
         for tile_name, tile_data in self.tile_list.items():
             tile = tile_data["tile"]
             query = tile_data["query"]
@@ -149,6 +273,8 @@ class TileManager(object):
 
     def compute_krige(self, var_param, result_dict, window_range=1,
                       upscale=2):
+        from greenstreet.greenery.kriging import krige_greenery
+
         krige_dir = self.get_krige_dir()
 #         print([tile_list[tile]["local_id_x"] for tile in self.tile_list])
         n_tiles_x = max([tile["local_id_x"] for tile in self.tile_list.values()]) + 1
@@ -217,6 +343,8 @@ class TileManager(object):
         krige_dir = self.get_krige_dir()
         variogram_fp = Path(krige_dir, "variogram.json")
 
+        from greenstreet.greenery.semivariogram import _semivariance
+
         semi_param = _semivariance(self.tile_list, results, plot=plot)
         with open(variogram_fp, "w") as f:
             json.dump(semi_param, f)
@@ -3,15 +3,82 @@ import sys
 import argparse
 
 from greenstreet.mapper import compute_map
+from greenstreet.migrate import migrate
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        return main_migrate()
+
     parser = argument_parser()
     args = parser.parse_args(sys.argv[1:])
 
     compute_map(**vars(args))
 
 
+def main_migrate():
+    parser = migrate_parser()
+    args = parser.parse_args(sys.argv[2:])
+
+    summary = migrate(**vars(args))
+    print(f"Converted: {summary['n_converted']}, already converted:"
+          f" {summary['n_skipped']}, failed: {summary['n_failed']}")
+    for failure in summary["failures"]:
+        print(failure)
+    if summary["n_failed"]:
+        sys.exit(1)
+
+
+def migrate_parser():
+    parser = argparse.ArgumentParser(
+        prog=sys.argv[0] + " migrate",
+        description="Convert stored segmentations and greenery to the current"
+                    " storage format. Can be run again to resume."
+    )
+    parser.add_argument(
+        "data_dir",
+        type=str,
+        help="Data directory to convert, e.g. 'data.amsterdam/amsterdam'."
+    )
+    parser.add_argument(
+        "-n", "--workers",
+        type=int,
+        default=None,
+        dest="n_worker",
+        help="Number of processes. Default: number of cores."
+    )
+    parser.add_argument(
+        "--packs",
+        default=False,
+        dest="use_packs",
+        action="store_true",
+        help="Move segmentations, greenery and meta data into one pack file"
+             " per tile and stage (for use with --packs), instead of"
+             " converting segmentations to the npz format."
+    )
+    parser.add_argument(
+        "--remove",
+        default=False,
+        dest="remove",
+        action="store_true",
+        help="Remove the original files after they are converted and"
+             " verified."
+    )
+    return parser
+
+
+def _positive_int(value):
+    " Argument type for integers of at least 1. "
+    try:
+        int_value = int(value)
+    except ValueError:
+        int_value = 0
+    if int_value < 1:
+        raise argparse.ArgumentTypeError(
+            f"should be a positive integer, not '{value}'")
+    return int_value
+
+
 def argument_parser():
     parser = argparse.ArgumentParser(
         prog=sys.argv[0],
@@ -22,7 +89,8 @@ def argument_parser():
         type=str,
         default="deeplab-mobilenet",
         help="Machine learning model for segmentation of images. "
-             "Default: 'deeplab-mobilenet'"
+             "Default: 'deeplab-mobilenet'. Use 'stub-color' for a fast"
+             " synthetic segmentation without TensorFlow (for testing)."
     )
     parser.add_argument(
         "-g", "--greenery-measure",
@@ -99,4 +167,169 @@ def argument_parser():
         help="Only do the kriging in parallel; use if segmentation is there,"
              " but kriging not yet."
     )
+    parser.add_argument(
+        "--refresh-meta",
+        default=False,
+        dest="refresh_meta",
+        action="store_true",
+        help="Retrieve panoramas that are newer than the stored meta data,"
+             " only tiles with new panoramas are recomputed."
+    )
+    parser.add_argument(
+        "--picture-store",
+        default=False,
+        dest="use_picture_store",
+        action="store_true",
+        help="Share downloaded pictures between data directories through a"
+             " picture store. The store has no size limit, and pictures are"
+             " copied instead of hard linked if it is on another file"
+             " system than the data directory."
+    )
+    parser.add_argument(
+        "--picture-store-dir",
+        type=str,
+        default=None,
+        dest="picture_store_dir",
+        help="Directory of the picture store. Default:"
+             " $GREENSTREET_CACHE/pictures or ~/.cache/greenstreet/pictures."
+    )
+    parser.add_argument(
+        "--in-memory",
+        default=False,
+        dest="in_memory",
+        action="store_true",
+        help="Pass downloaded pictures to the segmentation in memory,"
+             " without writing them to disk."
+    )
+    parser.add_argument(
+        "--keep-pictures",
+        default=False,
+        dest="keep_pictures",
+        action="store_true",
+        help="With --in-memory, still write the pictures to disk after"
+             " segmentation."
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=16,
+        dest="n_download",
+        help="Maximum number of pictures that are downloaded concurrently."
+             " Default: 16"
+    )
+    parser.add_argument(
+        "--download-rate",
+        type=float,
+        default=None,
+        dest="download_rate",
+        help="Maximum number of picture requests per second to a host,"
+             " shared by all download workers. Default: 10"
+    )
+    parser.add_argument(
+        "--download-burst",
+        type=float,
+        default=None,
+        dest="download_burst",
+        help="Number of picture requests to a host that can be done in quick"
+             " succession. Default: 20"
+    )
+    parser.add_argument(
+        "--decoders",
+        type=int,
+        default=2,
+        dest="n_decoder",
+        help="Number of threads that decode pictures in the background while"
+             " the model segments. 0: decode in the segmentation loop."
+             " Default: 2"
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=None,
+        dest="intra_op_threads",
+        help="Number of threads used within a segmentation operation."
+             " Default: chosen by TensorFlow."
+    )
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        default=None,
+        dest="inter_op_threads",
+        help="Number of segmentation operations run in parallel."
+             " Default: chosen by TensorFlow."
+    )
+    parser.add_argument(
+        "--warm-up",
+        default=False,
+        dest="warm_up",
+        action="store_true",
+        help="Run the segmentation model once on a blank image at startup."
+    )
+    parser.add_argument(
+        "--fused",
+        default=False,
+        dest="fused",
+        action="store_true",
+        help="Compute greenery fractions directly after the segmentation,"
+             " without storing the segmentation maps."
+    )
+    parser.add_argument(
+        "--qa-scale",
+        type=_positive_int,
+        default=None,
+        dest="qa_scale",
+        help="With --fused, store segmentation maps downsampled by this"
+             " factor for quality assurance."
+    )
+    parser.add_argument(
+        "--seg-workers",
+        type=int,
+        default=0,
+        dest="n_seg_workers",
+        help="Number of segmentation processes, each with its own model"
+             " (needs Python 3.8). Default: 0 (segment in the main"
+             " process)."
+    )
+    parser.add_argument(
+        "--seg-cache",
+        default=False,
+        dest="use_seg_cache",
+        action="store_true",
+        help="Cache segmentation results by picture content, so that"
+             " pictures shared between data directories are segmented only"
+             " once. The cache is limited to 2 GB."
+    )
+    parser.add_argument(
+        "--seg-cache-dir",
+        type=str,
+        default=None,
+        dest="seg_cache_dir",
+        help="Directory of the segmentation cache. Default:"
+             " $GREENSTREET_CACHE/segmentations or"
+             " ~/.cache/greenstreet/segmentations."
+    )
+    parser.add_argument(
+        "--packs",
+        default=False,
+        dest="use_packs",
+        action="store_true",
+        help="Store meta data, segmentations and greenery in one pack file"
+             " per tile and stage, instead of files per panorama."
+    )
+    parser.add_argument(
+        "--compact",
+        default=False,
+        dest="compact",
+        action="store_true",
+        help="Remove overwritten records from the pack files and exit."
+    )
+    parser.add_argument(
+        "--persist-weights",
+        default=False,
+        dest="persist_weights",
+        action="store_true",
+        help="Store the pixel weights of the greenery model in"
+             " $GREENSTREET_CACHE (or ~/.cache/greenstreet), so that all"
+             " processes on a node share them."
+    )
     return parser
@@ -1,3 +1,5 @@
+import os
+
 PICTURE_NAMES = {
     "adam-panorama": ["adam-panorama.jpg"],
     "adam-cubic": ["adam-front.jpg", "adam-back.jpg", "adam-left.jpg",
@@ -10,3 +12,8 @@ for pic_type, files in PICTURE_NAMES.items():
 
 STATUS_OK = 0
 STATUS_FAIL = 1
+
+# Directory for data that is shared between data directories and runs.
+CACHE_DIR = os.environ.get(
+    "GREENSTREET_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "greenstreet"))
@@ -1,2 +1,13 @@
-from greenstreet.greenery.visualization import plot_greenery
-from greenstreet.greenery.visualization import create_kriged_overlay
+# The visualization module imports matplotlib and pykrige, so it is only
+# imported on use.
+_LAZY_ATTRIBUTES = {
+    "plot_greenery": "greenstreet.greenery.visualization",
+    "create_kriged_overlay": "greenstreet.greenery.visualization",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__} has no attribute {name}")
+    from importlib import import_module
+    return getattr(import_module(_LAZY_ATTRIBUTES[name]), name)
@@ -6,41 +6,136 @@ from math import pi
 
 import numpy as np
 
+from greenstreet.greenery.weight_cache import WeightCache
+
 
 class BaseGreenery(ABC):
     name = "base"
 
     def transform(self, seg_res):
-        return self.green_fractions(
-            seg_res["seg_map"], seg_res["color_map"][0])
+        """ Class fractions of a segmentation result.
+
+        The result has either a full segmentation map ("seg_map") or a
+        run-length encoded one ("seg_runs"), which is used without
+        decoding it.
+        """
+        return dict(zip(seg_res["color_map"][0],
+                        self.mean_fractions([seg_res])))
+
+    def mean_fractions(self, seg_results):
+        """ Class fractions averaged over segmentation results.
+
+        Arguments
+        ---------
+        seg_results: list
+            Segmentation results with the same color map, e.g. of the
+            faces of a cubic panorama.
+
+        Returns
+        -------
+        np.array:
+            Fraction of each class of the color map.
+        """
+        n_class = len(seg_results[0]["color_map"][0])
+        if all("seg_runs" in seg_res for seg_res in seg_results):
+            return self.class_fractions_rle(
+                [seg_res["seg_runs"] for seg_res in seg_results], n_class)
+
+        # Stacking the maps would copy them, so they are counted one by
+        # one; the fractions are fixed length vectors, averaged at once.
+        return np.mean([
+            self.class_fractions(seg_res["seg_map"], n_class)
+            if "seg_map" in seg_res
+            else self.class_fractions_rle([seg_res["seg_runs"]], n_class)
+            for seg_res in seg_results], axis=0)
 
-    @abstractmethod
     def green_fractions(self, seg_map, names):
-        raise NotImplementedError
+        return dict(zip(names, self.class_fractions(seg_map, len(names))))
 
+    def green_fractions_rle(self, seg_runs, names):
+        " Same as green_fractions, for a RunLengthSegMap. "
+        return dict(zip(names, self.class_fractions_rle([seg_runs],
+                                                        len(names))))
 
-class GreeneryWeighted(BaseGreenery):
-    "Greenery as the percentage of the pixels from the vegetation class."
-    name = "weighted"
+    @abstractmethod
+    def class_fractions(self, seg_maps, n_class):
+        """ Class fractions of one or more segmentation maps.
+
+        Arguments
+        ---------
+        seg_maps: np.array
+            Segmentation map (H, W) or stacked maps (n_map, H, W).
+        n_class: int
+            Number of classes.
+
+        Returns
+        -------
+        np.array:
+            Fraction of each class, averaged over the maps.
+        """
+        raise NotImplementedError
 
-    def __init__(self):
-        self.partition_sum = {}
-        self.weights_store = {}
+    def class_fractions_rle(self, seg_runs_list, n_class):
+        " Same as class_fractions, for a list of RunLengthSegMap's. "
+        return np.mean([self.class_fractions(seg_runs.decode(), n_class)
+                        for seg_runs in seg_runs_list], axis=0)
 
-    def green_fractions(self, seg_map, names):
-        shape = seg_map.shape
-        if str(shape) not in self.weights_store:
-            self.weights_store[str(shape)] = self.weights(shape)
 
-        if str(shape) not in self.partition_sum:
-            partition_sum = np.sum(self.weights_store[str(shape)])
-            self.partition_sum[str(shape)] = partition_sum
-
-        weights = self.weights_store[str(shape)]
-        tot_frac = self.partition_sum[str(shape)]
+class GreeneryWeighted(BaseGreenery):
+    """ Greenery as the percentage of the pixels from the vegetation class.
+
+    Arguments
+    ---------
+    weight_cache: WeightCache
+        Cache for the pixel weights, default: the in-memory cache that is
+        shared by all models of the process.
+    """
+    name = "weighted"
 
-        counts = np.bincount(seg_map.reshape(-1), weights=weights)
-        return dict(zip(names, counts/tot_frac))
+    def __init__(self, weight_cache=None):
+        if weight_cache is None:
+            weight_cache = WeightCache.shared()
+        self.weight_cache = weight_cache
+
+    def shape_weights(self, shape):
+        " Weights of the pixels of maps with a shape, and their sum. "
+        return self.weight_cache.weights(self, shape)
+
+    def class_fractions(self, seg_maps, n_class):
+        seg_maps = np.asarray(seg_maps)
+        shape = seg_maps.shape[-2:]
+        weights, tot_frac = self.shape_weights(shape)
+
+        # The same weights are used for all maps, without repeating them.
+        counts = np.sum([
+            np.bincount(seg_map, weights=weights, minlength=n_class)[:n_class]
+            for seg_map in seg_maps.reshape(-1, weights.size)], axis=0)
+        n_map = seg_maps.size//weights.size
+        return counts/(n_map*tot_frac)
+
+    def class_fractions_rle(self, seg_runs_list, n_class):
+        labels = np.concatenate([seg_runs.labels
+                                 for seg_runs in seg_runs_list])
+        weights = np.concatenate([
+            self.run_weights(seg_runs)/self.shape_weights(seg_runs.shape)[1]
+            for seg_runs in seg_runs_list])
+
+        counts = np.bincount(labels, weights=weights, minlength=n_class)
+        return counts[:n_class]/len(seg_runs_list)
+
+    def run_weights(self, seg_runs):
+        """ Total weight of the pixels of each run.
+
+        Computed from the cumulative weights within each row, which are
+        stored as a (height, width+1) table.
+        """
+        shape = seg_runs.shape
+        cum_weights = self.weight_cache.cum_weights(self, shape)
+        starts = seg_runs.starts
+        # Index of the start of the run in the table, which has an extra
+        # column per row.
+        i_start = starts + starts//shape[1]
+        return cum_weights[i_start+seg_runs.lengths] - cum_weights[i_start]
 
     @abstractmethod
     def weights(self, matrix_shape):
@@ -51,16 +146,12 @@ class CubicWeighted(GreeneryWeighted):
     name = "cubic-weighted"
 
     def weights(self, matrix_shape):
-        idx = np.indices(matrix_shape)
-        xval = idx[1].reshape(-1)
-        yval = idx[0].reshape(-1)
-
-        dx = 2*xval/matrix_shape[1] - 1
-        dy = 2*yval/matrix_shape[0] - 1
+        dx = 2*np.arange(matrix_shape[1])/matrix_shape[1] - 1
+        dy = 2*np.arange(matrix_shape[0])/matrix_shape[0] - 1
 
-        fac = (dx**2+dy**2+1)**-1.5
+        fac = (dx.reshape(1, -1)**2 + dy.reshape(-1, 1)**2 + 1)**-1.5
 
-        return fac
+        return fac.reshape(-1)
 
 
 class PanoramaWeighted(GreeneryWeighted):
@@ -68,19 +159,33 @@ class PanoramaWeighted(GreeneryWeighted):
     name = "panorama-weighted"
 
     def weights(self, matrix_shape):
-        idx = np.indices(matrix_shape)
-        yval = idx[0].reshape(-1)
+        return np.repeat(self.row_weights(matrix_shape[0]), matrix_shape[1])
 
-        dy = (0.5 + yval)/matrix_shape[0]
-        fac = np.sin(dy*pi)
-        return fac
+    def row_weights(self, n_row):
+        " Weights only depend on the row of the pixel. "
+        dy = (0.5 + np.arange(n_row))/n_row
+        return np.sin(dy*pi)
+
+    def run_weights(self, seg_runs):
+        return seg_runs.lengths*self.row_weights(seg_runs.shape[0])[
+            seg_runs.rows]
 
 
 class GreeneryUnweighted(BaseGreenery):
     name = "unweighted"
 
-    def green_fractions(self, seg_map, names):
-        tot_frac = seg_map.shape[0] * seg_map.shape[1]
+    def class_fractions(self, seg_maps, n_class):
+        seg_maps = np.asarray(seg_maps)
+
+        counts = np.bincount(seg_maps.reshape(-1), minlength=n_class)
+        return counts[:n_class]/seg_maps.size
+
+    def class_fractions_rle(self, seg_runs_list, n_class):
+        labels = np.concatenate([seg_runs.labels
+                                 for seg_runs in seg_runs_list])
+        weights = np.concatenate([
+            seg_runs.lengths/(seg_runs.shape[0]*seg_runs.shape[1])
+            for seg_runs in seg_runs_list])
 
-        counts = np.bincount(seg_map.reshape(-1))
-        return dict(zip(names, counts/tot_frac))
+        counts = np.bincount(labels, weights=weights, minlength=n_class)
+        return counts[:n_class]/len(seg_runs_list)
@@ -0,0 +1,112 @@
+'''
+Cache of the pixel weights of greenery models, shared within a process.
+'''
+
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+class WeightCache():
+    """ Pixel weights of greenery models keyed by model and map shape.
+
+    Weights are stored as float32, together with their sum (partition
+    sum) and, when needed, the cumulative weights within rows that are
+    used for run-length encoded maps. With a cache directory, the arrays
+    are written as .npy files and memory mapped, so that all processes
+    on a node use the same buffers instead of computing their own.
+
+    Use WeightCache.shared to get the cache of the process.
+
+    Arguments
+    ---------
+    cache_dir: str
+        Directory for the weight files. None: keep them in memory only.
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._store = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, cache_dir=None):
+        " Weight cache of the process for a cache directory (or None). "
+        key = None if cache_dir is None else str(Path(cache_dir).resolve())
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(cache_dir)
+            return cls._shared[key]
+
+    def weights(self, model, shape):
+        """ Flattened weights of the pixels of a map and their sum.
+
+        Arguments
+        ---------
+        model: GreeneryWeighted
+            Greenery model that computes the weights.
+        shape: tuple
+            Shape (height, width) of the segmentation map.
+
+        Returns
+        -------
+        tuple:
+            Weights (np.float32 array) and partition sum (float).
+        """
+        entry = self._entry(model, shape)
+        return entry["weights"], entry["partition_sum"]
+
+    def cum_weights(self, model, shape):
+        """ Cumulative weights within rows, as a flattened (H, W+1) table.
+
+        The table is float64, so that differences between its entries
+        (the weights of runs) are accurate.
+        """
+        entry = self._entry(model, shape)
+        with self._lock:
+            if "cum_weights" not in entry:
+                entry["cum_weights"] = self._load_or_create(
+                    model, shape, "cum",
+                    lambda: _cum_weights(entry["weights"], shape))
+            return entry["cum_weights"]
+
+    def _entry(self, model, shape):
+        shape = tuple(int(x) for x in shape)
+        key = (model.name, shape)
+        with self._lock:
+            if key not in self._store:
+                weights = self._load_or_create(
+                    model, shape, "weights",
+                    lambda: np.asarray(model.weights(shape),
+                                       dtype=np.float32).reshape(-1))
+                self._store[key] = {
+                    "weights": weights,
+                    "partition_sum": float(np.sum(weights, dtype=np.float64)),
+                }
+            return self._store[key]
+
+    def _load_or_create(self, model, shape, kind, create):
+        if self.cache_dir is None:
+            return create()
+        weight_fp = Path(self.cache_dir,
+                         f"{model.name}_{shape[0]}x{shape[1]}_{kind}.npy")
+        if not weight_fp.is_file():
+            tmp_fp = Path(str(weight_fp) + f".{os.getpid()}"
+                          f".{threading.get_ident()}.part")
+            with open(tmp_fp, "wb") as f:
+                np.save(f, create())
+            os.replace(tmp_fp, weight_fp)
+        return np.load(weight_fp, mmap_mode="r")
+
+
+def _cum_weights(weights, shape):
+    cum_weights = np.zeros((shape[0], shape[1]+1))
+    np.cumsum(np.reshape(weights, shape), axis=1, dtype=np.float64,
+              out=cum_weights[:, 1:])
+    return cum_weights.reshape(-1)
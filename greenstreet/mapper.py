@@ -13,8 +13,14 @@ def compute_map(model='deeplab-mobilenet',
                 greenery_measure='vegetation',
                 n_job=1, job_id=0, bbox_str='amsterdam', grid_level=0,
                 krige_only=False, skip_overlay=False, prepare_only=False,
-                use_panorama=False, all_years=False,
-                data_dir=None):
+                use_panorama=False, all_years=False, n_download=16,
+                download_rate=None, download_burst=None,
+                refresh_meta=False, use_picture_store=False,
+                picture_store_dir=None, in_memory=False, keep_pictures=False,
+                n_decoder=2, intra_op_threads=None, inter_op_threads=None,
+                warm_up=False, fused=False, qa_scale=None, n_seg_workers=0,
+                use_seg_cache=False, seg_cache_dir=None, use_packs=False,
+                compact=False, persist_weights=False, data_dir=None):
 
     if data_dir is None:
         data_dir = Path("data.amsterdam", bbox_str)
@@ -29,8 +35,40 @@ def compute_map(model='deeplab-mobilenet',
                            seg_model_name=model,
                            use_panorama=use_panorama,
                            green_weights={greenery_measure: 1},
+                           n_download=n_download,
+                           download_rate=download_rate,
+                           download_burst=download_burst,
+                           use_picture_store=use_picture_store,
+                           picture_store_dir=picture_store_dir,
+                           in_memory=in_memory,
+                           keep_pictures=keep_pictures,
+                           n_decoder=n_decoder,
+                           seg_kwargs={
+                               "intra_op_threads": intra_op_threads,
+                               "inter_op_threads": inter_op_threads,
+                               "warm_up": warm_up,
+                           },
+                           fused=fused,
+                           qa_scale=qa_scale,
+                           n_seg_workers=n_seg_workers,
+                           use_seg_cache=use_seg_cache,
+                           seg_cache_dir=seg_cache_dir,
+                           use_packs=use_packs,
+                           persist_weights=persist_weights,
                            data_dir=data_dir)
 
+    if compact:
+        old_size, new_size = tile_man.compact_packs()
+        print(f"Compacted pack files from {old_size/1024**2:.1f} MB to"
+              f" {new_size/1024**2:.1f} MB")
+        return
+
+    if refresh_meta:
+        changed_tiles = tile_man.refresh_meta()
+        print(f"New panoramas in {len(changed_tiles)} tiles:")
+        for tile_name, pano_ids in changed_tiles.items():
+            print(f"{tile_name}: {len(pano_ids)}")
+
     jobs = tile_man.get_jobs()
     summarize_jobs(jobs)
     print(green_res)
@@ -0,0 +1,215 @@
+'''
+Conversion of stored panorama results to the current storage formats.
+
+Segmentations in the JSON (zlib + base64) format are converted to the
+binary npz format, or, with use_packs, segmentations, greenery and meta
+data files of panoramas are moved into the pack files of their tile.
+'''
+
+import os
+import json
+import multiprocessing as mp
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from greenstreet.API.base.job import load_segmentation,\
+    segmentation_to_bytes, segmentation_from_bytes
+from greenstreet.API.base.pack import open_pack, tile_pack_fp
+
+
+def migrate(data_dir, n_worker=None, use_packs=False, remove=False):
+    """ Convert all panorama results below a data directory.
+
+    Tiles (directories with a pics directory) are converted in parallel.
+    Every converted segmentation is decoded again and its seg maps are
+    compared with the original. Results that are already converted are
+    skipped, so the migration can be resumed after an interruption; they
+    are only counted as skipped (and removed) if the converted result has
+    the same content as the original.
+
+    Arguments
+    ---------
+    data_dir: str
+        Directory to convert, e.g. data.amsterdam/amsterdam.
+    n_worker: int
+        Number of processes, default: number of cores.
+    use_packs: bool
+        Move results into pack files of the tiles instead of converting
+        the segmentation files to the npz format.
+    remove: bool
+        Remove the original files after successful conversion.
+
+    Returns
+    -------
+    dict:
+        Number of converted, skipped and failed results, and the failures.
+    """
+    tile_dirs = sorted(set(pics_dir.parent for pics_dir
+                           in Path(data_dir).glob("**/pics")
+                           if pics_dir.is_dir()))
+    summary = {"n_converted": 0, "n_skipped": 0, "n_failed": 0,
+               "failures": []}
+    if not len(tile_dirs):
+        return summary
+
+    context = mp.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=n_worker,
+                             mp_context=context) as executor:
+        tile_results = executor.map(
+            migrate_tile, tile_dirs, [use_packs]*len(tile_dirs),
+            [remove]*len(tile_dirs))
+        for tile_res in tqdm(tile_results, total=len(tile_dirs)):
+            for key in ["n_converted", "n_skipped", "n_failed"]:
+                summary[key] += tile_res[key]
+            summary["failures"].extend(tile_res["failures"])
+    return summary
+
+
+def migrate_tile(tile_dir, use_packs=False, remove=False):
+    " Convert the results of all panoramas of one tile. "
+    tile_res = {"n_converted": 0, "n_skipped": 0, "n_failed": 0,
+                "failures": []}
+    for pano_dir in sorted(Path(tile_dir, "pics").iterdir()):
+        if not pano_dir.is_dir():
+            continue
+        for source_fp, convert in _conversions(pano_dir, use_packs):
+            try:
+                status = convert(source_fp, tile_dir, pano_dir.name)
+            except Exception as e:
+                status = f"{type(e).__name__}: {e}"
+            if status in ["converted", "skipped"]:
+                tile_res["n_" + status] += 1
+                if remove:
+                    os.remove(source_fp)
+            else:
+                tile_res["n_failed"] += 1
+                tile_res["failures"].append(f"{source_fp}: {status}")
+        if remove:
+            _remove_empty_dirs(pano_dir)
+    return tile_res
+
+
+def _conversions(pano_dir, use_packs):
+    " Files of a panorama with their conversion functions. "
+    seg_dir = Path(pano_dir, "segmentations")
+    green_dir = Path(pano_dir, "greenery")
+    conversions = []
+    if use_packs:
+        meta_fp = Path(pano_dir, "meta.json")
+        if meta_fp.is_file():
+            conversions.append((meta_fp, _meta_to_pack))
+        # A newer npz file takes precedence over the JSON file, so it is
+        # converted first.
+        for seg_fp in sorted(seg_dir.glob("*.npz")):
+            conversions.append((seg_fp, _segmentation_to_pack))
+        for seg_fp in sorted(seg_dir.glob("*.json")):
+            conversions.append((seg_fp, _segmentation_to_pack))
+        for green_fp in sorted(green_dir.glob("*.json")):
+            conversions.append((green_fp, _greenery_to_pack))
+    else:
+        for seg_fp in sorted(seg_dir.glob("*.json")):
+            conversions.append((seg_fp, _segmentation_to_npz))
+    return conversions
+
+
+def _segmentation_to_npz(seg_fp, tile_dir, pano_id):
+    npz_fp = seg_fp.with_suffix(".npz")
+    seg_res, panorama_type, segmentation_model = load_segmentation(seg_fp)
+    if npz_fp.is_file():
+        return _skipped_if_same_segmentation(
+            (seg_res, panorama_type, segmentation_model),
+            load_segmentation(npz_fp))
+    data = segmentation_to_bytes(seg_res, panorama_type, segmentation_model)
+    if not _same_segmentation(seg_res, segmentation_from_bytes(data)[0]):
+        return "seg maps differ after conversion"
+
+    tmp_fp = Path(str(npz_fp) + f".{os.getpid()}.part")
+    with open(tmp_fp, "wb") as f:
+        f.write(data)
+    os.replace(tmp_fp, npz_fp)
+    with open(npz_fp, "rb") as f:
+        if f.read() != data:
+            os.remove(npz_fp)
+            return "npz file differs after writing"
+    return "converted"
+
+
+def _segmentation_to_pack(seg_fp, tile_dir, pano_id):
+    pack = open_pack(tile_pack_fp(tile_dir, "segmentation"))
+    key = f"{seg_fp.stem}/{pano_id}"
+    seg_data = load_segmentation(seg_fp)
+    if key in pack:
+        return _skipped_if_same_segmentation(
+            seg_data, segmentation_from_bytes(pack.get(key)))
+    if seg_fp.suffix == ".json" and seg_fp.with_suffix(".npz").is_file():
+        return "npz file with the same segmentation was not converted"
+    seg_res, panorama_type, segmentation_model = seg_data
+    data = segmentation_to_bytes(seg_res, panorama_type, segmentation_model)
+    if not _same_segmentation(seg_res, segmentation_from_bytes(data)[0]):
+        return "seg maps differ after conversion"
+    return _put_verified(pack, key, data)
+
+
+def _greenery_to_pack(green_fp, tile_dir, pano_id):
+    pack = open_pack(tile_pack_fp(tile_dir, "greenery"))
+    key = f"{green_fp.stem}/{pano_id}"
+    with open(green_fp, "r") as f:
+        green_data = json.load(f)
+    if key in pack:
+        return _skipped_if_same(green_data == json.loads(pack.get(key)))
+    return _put_verified(pack, key, json.dumps(green_data).encode())
+
+
+def _meta_to_pack(meta_fp, tile_dir, pano_id):
+    pack = open_pack(tile_pack_fp(tile_dir, "meta"))
+    with open(meta_fp, "r") as f:
+        meta_data = json.load(f)
+    if pano_id in pack:
+        return _skipped_if_same(meta_data == json.loads(pack.get(pano_id)))
+    return _put_verified(pack, pano_id, json.dumps(meta_data).encode())
+
+
+def _put_verified(pack, key, data):
+    " Add a record to a pack file and check that it reads back the same. "
+    pack.put(key, data)
+    if pack.get(key) != data:
+        pack.delete(key)
+        return "pack record differs after writing"
+    return "converted"
+
+
+def _skipped_if_same(same):
+    " Status of a result that was converted before. "
+    if same:
+        return "skipped"
+    return "converted result exists, but differs from the original"
+
+
+def _skipped_if_same_segmentation(seg_data, converted_seg_data):
+    " Status of a segmentation that was converted before. "
+    seg_res, panorama_type, segmentation_model = seg_data
+    new_seg_res, new_panorama_type, new_segmentation_model = \
+        converted_seg_data
+    return _skipped_if_same(
+        panorama_type == new_panorama_type
+        and segmentation_model == new_segmentation_model
+        and _same_segmentation(seg_res, new_seg_res))
+
+
+def _same_segmentation(seg_res, new_seg_res):
+    if list(seg_res) != list(new_seg_res):
+        return False
+    return all(np.array_equal(np.asarray(seg_res[name]["seg_map"]),
+                              new_seg_res[name]["seg_map"])
+               for name in seg_res)
+
+
+def _remove_empty_dirs(pano_dir):
+    for sub_dir in ["segmentations", "greenery", ""]:
+        try:
+            Path(pano_dir, sub_dir).rmdir()
+        except OSError:
+            pass
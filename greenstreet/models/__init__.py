@@ -1 +1,16 @@
-from greenstreet.models.deeplab import DeepLabModel, plot_segmentation
+from greenstreet.models.base import SegmentationBackend
+from greenstreet.models.stub import StubModel
+from greenstreet.models.pool import SegmentationPool
+
+# The DeepLab module imports TensorFlow, so it is only imported on use.
+_LAZY_ATTRIBUTES = {
+    "DeepLabModel": "greenstreet.models.deeplab",
+    "plot_segmentation": "greenstreet.models.deeplab",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__} has no attribute {name}")
+    from importlib import import_module
+    return getattr(import_module(_LAZY_ATTRIBUTES[name]), name)
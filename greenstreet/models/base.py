@@ -0,0 +1,156 @@
+'''
+Interface of segmentation backends, and loading of the images they
+segment.
+'''
+
+from abc import ABC, abstractmethod
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from greenstreet.models.city_scapes import labels as cs_labels
+
+
+def open_image(image, target_size=None):
+    """ Open an image from a file, bytes or a file-like object.
+
+    Arguments
+    ---------
+    image: str, bytes or file-like
+        Image to open.
+    target_size: tuple
+        (width, height) the image will be resized to. JPEG images are then
+        decoded at the smallest scale (1/2, 1/4, 1/8) that still covers it,
+        which skips most of the decoding of large images.
+
+    Returns
+    -------
+    PIL.Image:
+        Opened (lazy) image; its size is the decoded size.
+    """
+    if isinstance(image, (bytes, bytearray)):
+        image = Image.open(BytesIO(image))
+    elif hasattr(image, "read"):
+        image = Image.open(image)
+    else:
+        with open(image, "rb") as f:
+            jpeg_str = f.read()
+        image = Image.open(BytesIO(jpeg_str))
+    if target_size is not None:
+        image.draft('RGB', target_size)
+    return image
+
+
+def resize_target(size, max_size):
+    """ Size of an image scaled down to max_size on its longest side. """
+    width, height = size
+    resize_ratio = 1.0 * max_size / max(width, height)
+    return (int(resize_ratio * width), int(resize_ratio * height))
+
+
+def load_resized(image_fp, max_size, draft=True):
+    """ Load an RGB image scaled down to max_size on its longest side.
+
+    With draft, JPEG images are decoded directly at a reduced scale
+    that still covers the target size, instead of at full resolution.
+    """
+    image = open_image(image_fp)
+    target_size = resize_target(image.size, max_size)
+    if draft:
+        image.draft('RGB', target_size)
+    return image.convert('RGB').resize(target_size, Image.LANCZOS)
+
+
+class SegmentationBackend(ABC):
+    """ Base class for segmentation models.
+
+    A backend segments RGB images into class maps. Images are resized to
+    INPUT_SIZE on their longest side (preprocess) before inference
+    (run_arrays), so that decoding and inference can be done separately.
+    The result of each image is a dictionary:
+
+        {"seg_map": np.array (height, width) with class indices,
+         "color_map": (label_names, label_colors)}
+
+    Subclasses implement name and run_arrays. The default label set is
+    the one of City-scapes (trainId's).
+    """
+    INPUT_SIZE = 513
+
+    # Maximum number of images per inference call, None if unlimited.
+    max_batch_size = None
+
+    @property
+    @abstractmethod
+    def name(self):
+        """ Returns an identifier for the model. """
+        raise NotImplementedError
+
+    @abstractmethod
+    def run_arrays(self, arrays, batch_size=8):
+        """ Runs inference on preprocessed (resized RGB) image arrays.
+
+        Arguments
+        ---------
+        arrays: list
+            Images as (height, width, 3) uint8 arrays.
+        batch_size: int
+            Maximum number of images per inference call.
+
+        Returns
+        -------
+        list:
+            Segmentation results in the same order as the arrays.
+        """
+        raise NotImplementedError
+
+    def load_segmentation_scheme(self):
+        """ Load the City-scapes segmentation/color scheme. """
+        self.label_names = []
+        self.label_colors = []
+
+        for label in cs_labels:
+            if label.trainId != 255:
+                self.label_names.append(label.name)
+                self.label_colors.append(list(label.color))
+        self.label_names = np.asarray(self.label_names)
+        self.label_colors = np.asarray(self.label_colors)
+        self.color_map = (self.label_names, self.label_colors)
+
+    def run(self, image_fp):
+        """ Runs inference on a single image.
+
+        Arguments
+        ---------
+        image_fp: str, bytes or file-like
+            File of the image, or its (JPEG) content.
+
+        Returns
+        -------
+        dict:
+            Segmentation map and color map of the resized image.
+        """
+        return self.run_batch([image_fp])[0]
+
+    def run_batch(self, images, batch_size=8):
+        """ Runs inference on multiple images.
+
+        Arguments
+        ---------
+        images: list
+            Images (files, bytes or file-like objects).
+        batch_size: int
+            Maximum number of images per inference call.
+
+        Returns
+        -------
+        list:
+            Results in the same format as run, in the order of the images.
+        """
+        return self.run_arrays([self.preprocess(image) for image in images],
+                               batch_size=batch_size)
+
+    def preprocess(self, image_fp, draft=True):
+        """ Load an image and resize it to the input size of the model. """
+        return np.asarray(load_resized(image_fp, self.INPUT_SIZE, draft=draft))
@@ -8,17 +8,15 @@ Based on https://github.com/tensorflow/models/blob/master/research/
 '''
 
 import os
-from io import BytesIO
 import tarfile
+from time import perf_counter
 from six.moves import urllib
 import operator
 
-from matplotlib import gridspec
-from matplotlib import pyplot as plt
 import numpy as np
 from PIL import Image
 
-from greenstreet.models.city_scapes import labels as cs_labels
+from greenstreet.models.base import SegmentationBackend, open_image
 
 try:
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
@@ -33,7 +31,11 @@ except ImportError:
 
 
 def _get_model(model_name):
-    """ Download/find a DeepLab model from an abbreviated model_name. """
+    """ Download/find a DeepLab model from an abbreviated model_name.
+
+    Returns the tar archive of the model and the file of its cached
+    frozen graph (which might not exist yet).
+    """
     model_dir = "pre_trained_models"
     url_prefix = 'http://download.tensorflow.org/models/'
 
@@ -50,15 +52,41 @@ def _get_model(model_name):
 
     model_url = url_prefix+tar_file
     tar_fp = os.path.join(model_dir, tar_file)
+    graph_fp = os.path.join(model_dir, tar_file[:-len(".tar.gz")] + ".pb")
+    if os.path.exists(graph_fp):
+        return tar_fp, graph_fp
     if not os.path.exists(tar_fp):
         os.makedirs(model_dir, exist_ok=True)
         print('Downloading model...')
         urllib.request.urlretrieve(model_url, tar_fp)
         print('Download completed.')
-    return tar_fp
+    return tar_fp, graph_fp
+
+
+def _extract_graph(tar_fp, graph_fp, graph_name):
+    """ Extract the serialized frozen graph from a model tar archive.
+
+    The graph is stored in graph_fp, so that later runs can skip the
+    decompression of the archive.
+    """
+    graph_str = None
+    with tarfile.open(tar_fp) as tar_file:
+        for tar_info in tar_file.getmembers():
+            if graph_name in os.path.basename(tar_info.name):
+                graph_str = tar_file.extractfile(tar_info).read()
+                break
+
+    if graph_str is None:
+        raise RuntimeError('Cannot find inference graph in tar archive.')
+
+    tmp_fp = graph_fp + f".{os.getpid()}.part"
+    with open(tmp_fp, "wb") as f:
+        f.write(graph_str)
+    os.replace(tmp_fp, graph_fp)
+    return graph_str
 
 
-class DeepLabModel(object):
+class DeepLabModel(SegmentationBackend):
     """ Class to load DeepLab model and run inference. """
 
     INPUT_TENSOR_NAME = 'ImageTensor:0'
@@ -66,93 +94,109 @@ class DeepLabModel(object):
     INPUT_SIZE = 513
     FROZEN_GRAPH_NAME = 'frozen_inference_graph'
 
-    def __init__(self, model_name="mobilenet"):
-        """ Creates and loads pretrained deeplab model. """
+    def __init__(self, model_name="mobilenet", intra_op_threads=None,
+                 inter_op_threads=None, warm_up=False):
+        """ Creates and loads pretrained deeplab model.
+
+        Args:
+            model_name: Abbreviated name of the DeepLab model.
+            intra_op_threads: Number of threads used within an operation,
+                default (None): chosen by TensorFlow.
+            inter_op_threads: Number of operations that are run in
+                parallel, default (None): chosen by TensorFlow.
+            warm_up: Run inference on a blank image after loading, so that
+                the first real image does not pay for the initialization.
+        """
         self.graph = tf.Graph()
         self.sess = None
-        self.load(model_name)
-        self.load_segmentation_scheme()
         self.model_name = model_name
+        self.startup_time = {}
+
+        t_start = perf_counter()
+        self.load(model_name, intra_op_threads=intra_op_threads,
+                  inter_op_threads=inter_op_threads)
+        self.startup_time["load"] = perf_counter() - t_start
+        self.load_segmentation_scheme()
+        if warm_up:
+            t_start = perf_counter()
+            self.warm_up()
+            self.startup_time["warm_up"] = perf_counter() - t_start
+        print(f"Started model {self.name}: " + ", ".join(
+            f"{key} {t:.2f}s" for key, t in self.startup_time.items()))
 
     @property
     def name(self):
         """ Returns an identifier for the model. """
         return "deeplab-" + self.model_name
 
-    def load(self, model_name):
-        """ Extract frozen graph from tar archive. """
-        tarball_fp = _get_model(model_name)
-        tar_file = tarfile.open(tarball_fp)
-        for tar_info in tar_file.getmembers():
-            if self.FROZEN_GRAPH_NAME in os.path.basename(tar_info.name):
-                file_handle = tar_file.extractfile(tar_info)
-                graph_def = tf.GraphDef()
-                graph_def.ParseFromString(file_handle.read())
-                break
-        tar_file.close()
-
-        if graph_def is None:
-            raise RuntimeError('Cannot find inference graph in tar archive.')
+    def load(self, model_name, intra_op_threads=None, inter_op_threads=None):
+        """ Load the frozen graph, from the cache or the tar archive. """
+        tar_fp, graph_fp = _get_model(model_name)
+        if os.path.exists(graph_fp):
+            with open(graph_fp, "rb") as f:
+                graph_str = f.read()
+        else:
+            graph_str = _extract_graph(tar_fp, graph_fp,
+                                       self.FROZEN_GRAPH_NAME)
+        graph_def = tf.GraphDef()
+        graph_def.ParseFromString(graph_str)
 
         with self.graph.as_default():
             tf.import_graph_def(graph_def, name='')
 
-        self.sess = tf.Session(graph=self.graph)
+        config = tf.ConfigProto(
+            intra_op_parallelism_threads=intra_op_threads or 0,
+            inter_op_parallelism_threads=inter_op_threads or 0)
+        self.sess = tf.Session(graph=self.graph, config=config)
 
-    def load_segmentation_scheme(self):
-        """ Load the City-scapes segmentation/color scheme. """
-        self.label_names = []
-        self.label_colors = []
+        # Some exported graphs only accept a single image per call.
+        batch_dim = self.graph.get_tensor_by_name(
+            self.INPUT_TENSOR_NAME).shape.as_list()[0]
+        self.max_batch_size = batch_dim
 
-        for label in cs_labels:
-            if label.trainId != 255:
-                self.label_names.append(label.name)
-                self.label_colors.append(list(label.color))
-        self.label_names = np.asarray(self.label_names)
-        self.label_colors = np.asarray(self.label_colors)
-        self.color_map = (self.label_names, self.label_colors)
+    def warm_up(self):
+        """ Run inference once, to initialize the graph. """
+        blank = np.zeros((self.INPUT_SIZE, self.INPUT_SIZE, 3), dtype=np.uint8)
+        self.run_arrays([blank])
 
-    def run(self, image_fp):
-        """Runs inference on a single image.
-
-        Args:
-            image: A PIL.Image object, raw input image.
+    def run_arrays(self, arrays, batch_size=8):
+        """ Runs inference on preprocessed (resized RGB) image arrays.
 
-        Returns:
-            resized_image: RGB image resized from original input image.
-            seg_map: Segmentation map of `resized_image`.
+        Arrays are grouped by their shape and every group is fed to the
+        graph in batches of at most batch_size.
         """
-        with open(image_fp, "rb") as f:
-            jpeg_str = f.read()
-        image = Image.open(BytesIO(jpeg_str))
-
-        width, height = image.size
-        resize_ratio = 1.0 * self.INPUT_SIZE / max(width, height)
-        target_size = (int(resize_ratio * width), int(resize_ratio * height))
-        resized_image = image.convert('RGB').resize(
-            target_size, Image.ANTIALIAS)
-        batch_seg_map = self.sess.run(
-            self.OUTPUT_TENSOR_NAME,
-            feed_dict={self.INPUT_TENSOR_NAME: [np.asarray(resized_image)]})
-        seg_map = batch_seg_map[0]
-        results = {
-            'seg_map': seg_map,
-            'color_map': self.color_map
-        }
-        return results
+        if self.max_batch_size is not None:
+            batch_size = min(batch_size, self.max_batch_size)
+
+        shape_groups = {}
+        for i_image, array in enumerate(arrays):
+            shape_groups.setdefault(array.shape, []).append(i_image)
+
+        seg_maps = [None]*len(arrays)
+        for group in shape_groups.values():
+            for i_start in range(0, len(group), batch_size):
+                batch_idx = group[i_start:i_start+batch_size]
+                batch_seg_map = self.sess.run(
+                    self.OUTPUT_TENSOR_NAME,
+                    feed_dict={self.INPUT_TENSOR_NAME: np.stack(
+                        [arrays[i] for i in batch_idx])})
+                for i_batch, i_image in enumerate(batch_idx):
+                    seg_maps[i_image] = batch_seg_map[i_batch]
+        return [{'seg_map': seg_map, 'color_map': self.color_map}
+                for seg_map in seg_maps]
 
 
 def plot_segmentation(image_fp, seg_map, color_map, show=True,
                       plot_labels=None):
     """Visualizes input image, segmentation map and overlay view."""
+    from matplotlib import gridspec
+    from matplotlib import pyplot as plt
 
     # Resize the image to the segmentation map.
     seg_map = np.array(seg_map)
     seg_size = (seg_map.shape[1], seg_map.shape[0])
-    with open(image_fp, "rb") as f:
-        jpeg_str = f.read()
-    orig_image = Image.open(BytesIO(jpeg_str))
-    image = orig_image.resize(seg_size, Image.ANTIALIAS)
+    orig_image = open_image(image_fp, target_size=seg_size)
+    image = orig_image.convert('RGB').resize(seg_size, Image.LANCZOS)
 
     label_names = np.array(color_map[0])
     label_colors = np.array(color_map[1])
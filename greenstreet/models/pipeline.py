@@ -0,0 +1,143 @@
+'''
+Pipelined segmentation: decoding and resizing of images in background
+threads, while the model runs inference on the images that are ready.
+'''
+
+from queue import Queue
+from time import perf_counter, sleep
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InferencePipeline():
+    """ Producer/consumer pipeline around a segmentation model.
+
+    A pool of decoder threads loads and resizes images (model.preprocess)
+    into a bounded queue, which is drained by the model (model.run_arrays)
+    in the calling thread. PIL releases the GIL while decoding and
+    resizing, so the model does not have to wait for the decoding.
+
+    Arguments
+    ---------
+    model: SegmentationBackend
+        Model with preprocess and run_arrays methods.
+    n_decoder: int
+        Number of decoder threads.
+    queue_size: int
+        Maximum number of decoded images waiting for the model.
+    batch_size: int
+        Maximum number of images per inference call.
+    """
+    def __init__(self, model, n_decoder=2, queue_size=16, batch_size=8):
+        self.model = model
+        self.n_decoder = n_decoder
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.reset_stats()
+
+    @property
+    def name(self):
+        return self.model.name
+
+    def reset_stats(self):
+        self.stats = {
+            "n_image": 0,
+            "n_batch": 0,
+            "stall_time": 0.0,
+            "inference_time": 0.0,
+            "queue_depth_sum": 0,
+            "max_queue_depth": 0,
+        }
+
+    def report(self):
+        " Summary of the statistics, to size the decoder pool and queue. "
+        n_batch = max(1, self.stats["n_batch"])
+        return (
+            f"Segmentation pipeline: {self.stats['n_image']} images in"
+            f" {self.stats['n_batch']} batches, inference"
+            f" {self.stats['inference_time']:.1f}s, model stalled"
+            f" {self.stats['stall_time']:.1f}s waiting for decoders,"
+            f" queue depth avg {self.stats['queue_depth_sum']/n_batch:.1f}"
+            f" max {self.stats['max_queue_depth']}/{self.queue_size}"
+        )
+
+    def run_batch(self, images):
+        " Same as the run_batch method of the model. "
+        return list(self.imap(images))
+
+    def imap(self, images, return_exceptions=False):
+        """ Segment images, yielding the results in order.
+
+        Arguments
+        ---------
+        images: list
+            Images (files, bytes or file-like objects).
+        return_exceptions: bool
+            Yield the exception of an image that cannot be decoded in
+            place of its result, instead of raising it.
+
+        Returns
+        -------
+        generator:
+            Segmentation results in the same order as the images.
+        """
+        queue = Queue(maxsize=self.queue_size)
+        stop = Event()
+
+        def decode(i_image):
+            if stop.is_set():
+                return
+            try:
+                queue.put((i_image, self.model.preprocess(images[i_image])))
+            except Exception as e:
+                queue.put((i_image, e))
+
+        results = {}
+        i_next = 0
+        n_received = 0
+        executor = ThreadPoolExecutor(max_workers=self.n_decoder)
+        futures = [executor.submit(decode, i_image)
+                   for i_image in range(len(images))]
+        try:
+            while n_received < len(images):
+                depth = queue.qsize()
+                self.stats["queue_depth_sum"] += depth
+                self.stats["max_queue_depth"] = max(
+                    depth, self.stats["max_queue_depth"])
+
+                t_start = perf_counter()
+                batch = [queue.get()]
+                self.stats["stall_time"] += perf_counter() - t_start
+                while len(batch) < self.batch_size and not queue.empty():
+                    batch.append(queue.get())
+                n_received += len(batch)
+
+                for i_image, array in batch:
+                    if isinstance(array, Exception):
+                        if not return_exceptions:
+                            raise array
+                        results[i_image] = array
+                batch = [(i_image, array) for i_image, array in batch
+                         if not isinstance(array, Exception)]
+
+                if len(batch):
+                    t_start = perf_counter()
+                    batch_res = self.model.run_arrays(
+                        [array for _, array in batch],
+                        batch_size=self.batch_size)
+                    self.stats["inference_time"] += perf_counter() - t_start
+                    self.stats["n_image"] += len(batch)
+                    self.stats["n_batch"] += 1
+                    for (i_image, _), res in zip(batch, batch_res):
+                        results[i_image] = res
+                while i_next in results:
+                    yield results.pop(i_next)
+                    i_next += 1
+        finally:
+            # Unblock the decoders if we stopped early.
+            stop.set()
+            while not all(future.done() for future in futures):
+                while not queue.empty():
+                    queue.get()
+                sleep(0.001)
+            executor.shutdown()
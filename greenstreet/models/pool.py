@@ -0,0 +1,224 @@
+'''
+Pool of segmentation processes, each holding its own model. Images and
+segmentation maps are exchanged through shared memory buffers.
+'''
+
+import atexit
+import threading
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+
+from greenstreet.models.base import SegmentationBackend
+
+
+def _shared_memory():
+    """ SharedMemory class, imported on use since it needs Python 3.8.
+
+    Importing it at the top would make the whole package unusable on
+    older versions of Python, also without a segmentation pool.
+    """
+    try:
+        from multiprocessing.shared_memory import SharedMemory
+    except ImportError:
+        raise RuntimeError("Segmentation workers need Python 3.8 or newer.")
+    return SharedMemory
+
+
+def _worker_main(model_type, model_kwargs, batch_size, conn):
+    """ Main loop of a segmentation process.
+
+    The model is created first, after which the worker reports its name,
+    color map and input size. The parent then sends the names of the
+    shared memory buffers, followed by tasks: the shapes of the images in
+    the input buffer. The segmentation maps are written to the output
+    buffer and their shapes are sent back.
+    """
+    from greenstreet.utils.selection import get_segmentation_model
+    try:
+        model = get_segmentation_model(model_type, **model_kwargs)
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        return
+    conn.send(("ready", model.name, model.color_map, model.INPUT_SIZE))
+
+    in_name, out_name = conn.recv()
+    SharedMemory = _shared_memory()
+    in_shm = SharedMemory(name=in_name)
+    out_shm = SharedMemory(name=out_name)
+    try:
+        while True:
+            shapes = conn.recv()
+            if shapes is None:
+                break
+            try:
+                conn.send(("ok", _run_task(model, in_shm, out_shm, shapes,
+                                           batch_size)))
+            except Exception:
+                conn.send(("error", traceback.format_exc()))
+    finally:
+        in_shm.close()
+        out_shm.close()
+
+
+def _run_task(model, in_shm, out_shm, shapes, batch_size):
+    " Segment the images in the input buffer, returns the map shapes. "
+    arrays = _read_arrays(in_shm, shapes, np.uint8)
+    seg_maps = [res["seg_map"] for res in model.run_arrays(
+        arrays, batch_size=batch_size)]
+    _write_arrays(out_shm, seg_maps, np.int32)
+    return [seg_map.shape for seg_map in seg_maps]
+
+
+def _read_arrays(shm, shapes, dtype):
+    " Views of consecutive arrays in a shared memory buffer. "
+    arrays = []
+    offset = 0
+    for shape in shapes:
+        size = int(np.prod(shape))*np.dtype(dtype).itemsize
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf,
+                                 offset=offset))
+        offset += size
+    return arrays
+
+
+def _write_arrays(shm, arrays, dtype):
+    " Write arrays consecutively into a shared memory buffer. "
+    n_bytes = sum(int(np.prod(array.shape)) for array in arrays)
+    if n_bytes*np.dtype(dtype).itemsize > shm.size:
+        raise ValueError("Arrays do not fit in the shared memory buffer.")
+    for view, array in zip(_read_arrays(shm, [a.shape for a in arrays],
+                                        dtype), arrays):
+        view[...] = array
+
+
+class SegmentationPool(SegmentationBackend):
+    """ Segmentation backend that spreads inference over processes.
+
+    Every worker process loads its own copy of the model, so that the
+    cores of one node are used without sharding the work over jobs.
+    Decoded images are copied into a shared memory buffer of a worker
+    instead of being pickled, and segmentation maps are returned the same
+    way. The workers are started on first use.
+
+    Arguments
+    ---------
+    model_type: str
+        Type of the model, e.g. "deeplab-mobilenet".
+    n_worker: int
+        Number of worker processes.
+    model_kwargs: dict
+        Keyword arguments for the model of each worker.
+    batch_size: int
+        Maximum number of images per worker and inference call.
+    """
+    def __init__(self, model_type, n_worker=2, model_kwargs={},
+                 batch_size=8):
+        from greenstreet.utils.selection import get_segmentation_model
+        _shared_memory()
+        self.model_type = model_type
+        self.n_worker = n_worker
+        self.model_kwargs = model_kwargs
+        self.batch_size = batch_size
+        self._name = get_segmentation_model(model_type, lazy=True).name
+        self._color_map = None
+        self._workers = []
+        self._start_lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def color_map(self):
+        self.start()
+        return self._color_map
+
+    def start(self):
+        " Start the worker processes and wait until their models are loaded. "
+        with self._start_lock:
+            if not len(self._workers):
+                self._start()
+
+    def _start(self):
+        SharedMemory = _shared_memory()
+        context = mp.get_context("spawn")
+        for _ in range(self.n_worker):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_worker_main, daemon=True,
+                args=(self.model_type, self.model_kwargs, self.batch_size,
+                      child_conn))
+            process.start()
+            self._workers.append({"process": process, "conn": parent_conn,
+                                  "shm": []})
+        atexit.register(self.close)
+
+        for worker in self._workers:
+            message = worker["conn"].recv()
+            if message[0] == "error":
+                self.close()
+                raise RuntimeError("Segmentation worker failed to start:\n"
+                                   + message[1])
+            _, self._name, self._color_map, self.INPUT_SIZE = message
+            n_pixel = self.batch_size*self.INPUT_SIZE**2
+            worker["shm"] = [SharedMemory(create=True, size=3*n_pixel),
+                             SharedMemory(create=True, size=4*n_pixel)]
+            worker["conn"].send([shm.name for shm in worker["shm"]])
+
+    def preprocess(self, image_fp, draft=True):
+        self.start()
+        return super().preprocess(image_fp, draft=draft)
+
+    def run_arrays(self, arrays, batch_size=8):
+        """ Runs inference on preprocessed (resized RGB) image arrays.
+
+        The arrays are split into batches of the batch size of the pool
+        (the batch_size argument is ignored), which are segmented by all
+        workers at the same time.
+        """
+        self.start()
+        chunks = [list(range(i_start, min(i_start+self.batch_size,
+                                          len(arrays))))
+                  for i_start in range(0, len(arrays), self.batch_size)]
+        seg_maps = [None]*len(arrays)
+        for i_round in range(0, len(chunks), self.n_worker):
+            busy = []
+            for worker, chunk in zip(self._workers,
+                                     chunks[i_round:i_round+self.n_worker]):
+                chunk_arrays = [np.asarray(arrays[i], dtype=np.uint8)
+                                for i in chunk]
+                _write_arrays(worker["shm"][0], chunk_arrays, np.uint8)
+                worker["conn"].send([array.shape for array in chunk_arrays])
+                busy.append((worker, chunk))
+
+            errors = []
+            for worker, chunk in busy:
+                status, data = worker["conn"].recv()
+                if status == "error":
+                    errors.append(data)
+                    continue
+                for i_image, seg_map in zip(chunk, _read_arrays(
+                        worker["shm"][1], data, np.int32)):
+                    seg_maps[i_image] = seg_map.astype(np.int64)
+            if len(errors):
+                raise RuntimeError("Segmentation worker failed:\n"
+                                   + errors[0])
+        return [{'seg_map': seg_map, 'color_map': self._color_map}
+                for seg_map in seg_maps]
+
+    def close(self):
+        " Stop the workers and release the shared memory. "
+        for worker in self._workers:
+            try:
+                worker["conn"].send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            worker["process"].join(timeout=10)
+            if worker["process"].is_alive():
+                worker["process"].terminate()
+            for shm in worker["shm"]:
+                shm.close()
+                shm.unlink()
+        self._workers = []
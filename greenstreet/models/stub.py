@@ -0,0 +1,63 @@
+'''
+Fast and deterministic segmentation backend without TensorFlow, for
+benchmarks and load tests of the pipeline on any machine.
+'''
+
+from time import sleep
+
+import numpy as np
+
+from greenstreet.models.base import SegmentationBackend
+
+
+class StubModel(SegmentationBackend):
+    """ Synthetic segmentation from the colors of the pixels.
+
+    Greenish pixels are labeled vegetation, bluish pixels sky, the
+    remaining pixels in the bottom half road and the others building.
+    The result only depends on the image, so the same picture always has
+    the same segmentation and greenery.
+
+    Arguments
+    ---------
+    model_name: str
+        Variant of the stub, only "color" is available.
+    delay: float
+        Time (s) to sleep per image, to emulate the inference time of a
+        real model.
+    kwargs:
+        Options of other backends (e.g. session threads), which are ignored.
+    """
+    def __init__(self, model_name="color", delay=0.0, **kwargs):
+        if model_name != "color":
+            raise ValueError(f"Error: model {model_name} unknown")
+        self.model_name = model_name
+        self.delay = delay
+        self.load_segmentation_scheme()
+        label_id = {name: i for i, name in enumerate(self.label_names)}
+        self.vegetation_id = label_id["vegetation"]
+        self.sky_id = label_id["sky"]
+        self.road_id = label_id["road"]
+        self.building_id = label_id["building"]
+
+    @property
+    def name(self):
+        return "stub-" + self.model_name
+
+    def run_arrays(self, arrays, batch_size=8):
+        """ Segment preprocessed (resized RGB) image arrays. """
+        if self.delay > 0:
+            sleep(self.delay*len(arrays))
+        return [{'seg_map': self.segment(array), 'color_map': self.color_map}
+                for array in arrays]
+
+    def segment(self, array):
+        " Class map of a single (height, width, 3) image. "
+        rgb = np.asarray(array, dtype=np.int16)
+        red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+
+        seg_map = np.full(rgb.shape[:2], self.building_id, dtype=np.int64)
+        seg_map[rgb.shape[0]//2:] = self.road_id
+        seg_map[(blue > red + 20) & (blue > green)] = self.sky_id
+        seg_map[(green > red + 10) & (green > blue + 10)] = self.vegetation_id
+        return seg_map
@@ -39,49 +39,41 @@ class GridQuery():
         dx = (x_end-x_start)/nx
         dy = (y_end-y_start)/ny
 
-        # Sample list is a three dimensional list that contains all panoramas
-        # belonging to the mini tile. The mini tiles are aranged as
-        # [0-nx][0-ny].
-        mini_tile_list = np.empty((ny, nx), dtype=object)
-        for iy, ix in np.ndindex(mini_tile_list.shape):
-            mini_tile_list[iy][ix] = []
-
-        # Fill the sample list using the coordinates in the meta data.
-        coordinates = meta_data.coordinates()
-        for pano_id, coor in coordinates.items():
-            x, y = coor
-            ix = int((x-x_start)/dx)
-            iy = int((y-y_start)/dy)
-            if ix >= 0 and ix < nx and iy >= 0 and iy < ny:
-                mini_tile_list[ix][iy].append(pano_id)
-
-        # Go through all the mini tiles and select the ones closest to
-        # the corner of their mini tile.
-        load_ids = []
-        min_dist = [-1]
-        for iy, ix in np.ndindex(mini_tile_list.shape):
-            mini_tile = mini_tile_list[ix][iy]
-            # If there is nothing in the mini tile, skip.
-            if not len(mini_tile):
-                continue
-            min_dist[0] = 10.0**10
-            idx_min = -1
-
-            # Compute the base points of the mini tile (southwest corner).
-            x_base = x_start + dx*ix
-            y_base = y_start + dy*iy
-            y_fac, x_fac = degree_to_meter(y_base)
-            # Compute minimum distance correcting lattitude.
-            for i_meta in mini_tile:
-                x, y = coordinates[i_meta]
-                dist = ((x-x_base)*x_fac)**2 + ((y-y_base)*y_fac)**2
-                if dist < min_dist[0]:
-                    idx_min = i_meta
-                    min_dist[0] = dist
-
-            load_ids.append(idx_min)
-
-        return np.array(load_ids)
+        # Only consider panoramas in (or just around) the bounding box.
+        candidates = meta_data.in_bbox([
+            [y_start-dy, x_start-dx],
+            [y_end+dy, x_end+dx],
+        ])
+        coordinates = meta_data.coordinate_array()[candidates]
+        x = coordinates[:, 0]
+        y = coordinates[:, 1]
+
+        # Assign every panorama to a mini tile (truncating towards zero).
+        ix = ((x-x_start)/dx).astype(np.int64)
+        iy = ((y-y_start)/dy).astype(np.int64)
+        in_grid = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        candidates = candidates[in_grid]
+        x, y, ix, iy = x[in_grid], y[in_grid], ix[in_grid], iy[in_grid]
+
+        # Compute the distance to the base point of the mini tile
+        # (southwest corner), correcting for the lattitude.
+        # The factors are computed per row of mini tiles.
+        factors = np.array([degree_to_meter(y_start + dy*i_row)
+                            for i_row in range(ny)]).reshape(-1, 2)
+        y_fac = factors[iy, 0]
+        x_fac = factors[iy, 1]
+        x_base = x_start + dx*ix
+        y_base = y_start + dy*iy
+        dist = ((x-x_base)*x_fac)**2 + ((y-y_base)*y_fac)**2
+
+        # Select the closest panorama for each mini tile, ordered by mini
+        # tile (rows of constant latitude). The sort is stable, so for equal
+        # distances the first panorama in the meta data is selected.
+        cell = iy*nx + ix
+        order = np.lexsort((dist, cell))
+        _, i_first = np.unique(cell[order], return_index=True)
+        load_rows = candidates[order[i_first]]
+        return meta_data.pano_ids[load_rows]
 
     def to_file(self, query_fp, pano_ids):
         with open(query_fp, "w") as f:
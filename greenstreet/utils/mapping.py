@@ -3,10 +3,7 @@
 import json
 from json.decoder import JSONDecodeError
 from pathlib import Path
-import folium
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.linear_model import LinearRegression
 from tqdm import tqdm
 
 
@@ -117,6 +114,9 @@ class MapImageOverlay:
         return self.greenery[i_lat, i_long]
 
     def compare(self, overlay):
+        import matplotlib.pyplot as plt
+        from sklearn.linear_model import LinearRegression
+
         green_self = []
         green_overlay = []
         for lat in tqdm(self.lat_grid):
@@ -243,6 +243,8 @@ def create_map(green_layers, results, html_file="index.html"):
     html_file:
         Destination file for HTML map.
     """
+    import folium
+
     if isinstance(green_layers, MapImageOverlay):
         green_layers = [green_layers]
 
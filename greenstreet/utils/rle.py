@@ -0,0 +1,61 @@
+'''
+Run-length encoding of segmentation maps.
+'''
+
+import numpy as np
+
+
+class RunLengthSegMap():
+    """ Segmentation map as runs of equal labels within rows.
+
+    Segmentation maps consist mostly of large regions of the same class,
+    so they are much smaller as runs. Runs never cross the end of a row,
+    so that every run belongs to a single row.
+
+    Arguments
+    ---------
+    labels: np.array
+        Label of each run.
+    lengths: np.array
+        Number of pixels of each run.
+    shape: tuple
+        Shape (height, width) of the segmentation map.
+    """
+    def __init__(self, labels, lengths, shape):
+        self.labels = np.asarray(labels)
+        self.lengths = np.asarray(lengths)
+        self.shape = tuple(int(x) for x in shape)
+
+    @classmethod
+    def encode(cls, seg_map):
+        " Runs of a (2D) segmentation map. "
+        seg_map = np.asarray(seg_map)
+        flat = seg_map.reshape(-1)
+        if not flat.size:
+            return cls(flat, np.zeros(0, dtype=np.int64), seg_map.shape)
+        change = np.empty(flat.size, dtype=bool)
+        change[0] = True
+        np.not_equal(flat[1:], flat[:-1], out=change[1:])
+        change[::seg_map.shape[1]] = True
+        starts = np.flatnonzero(change)
+        lengths = np.diff(np.append(starts, flat.size))
+        return cls(flat[starts], lengths, seg_map.shape)
+
+    def decode(self):
+        " Full segmentation map. "
+        return np.repeat(self.labels, self.lengths).reshape(self.shape)
+
+    @property
+    def starts(self):
+        " Index of the first pixel of each run in the flattened map. "
+        starts = np.zeros(len(self.lengths), dtype=np.int64)
+        np.cumsum(self.lengths[:-1], out=starts[1:])
+        return starts
+
+    @property
+    def rows(self):
+        " Row of each run. "
+        return self.starts//self.shape[1]
+
+    def __len__(self):
+        return len(self.labels)
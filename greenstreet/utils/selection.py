@@ -1,16 +1,20 @@
 
 import sys
+import threading
+from pathlib import Path
+from importlib import import_module
 
-from greenstreet.models import DeepLabModel
+from greenstreet.config import CACHE_DIR
 from greenstreet.greenery.greenery import GreeneryUnweighted, CubicWeighted,\
     PanoramaWeighted
+from greenstreet.greenery.weight_cache import WeightCache
 from greenstreet.API.adam.panorama_job import AdamPanoramaJob
 from greenstreet.API.adam.cubic_job import AdamCubicJob
 
 
 def select_area(area, seg_model="mobilenet"):
     manager_kwargs = {
-        'seg_model': DeepLabModel,
+        'seg_model': get_model_class("deeplab"),
         'green_model': GreeneryUnweighted,
         'data_id': area,
         'seg_kwargs': {"model_name": seg_model}
@@ -76,29 +80,120 @@ def select_bbox(area="amsterdam"):
     return bbox
 
 
-def get_segmentation_model(model_type="deeplab-mobilenet", **kwargs):
-    model_sub = model_type.split('-')
-    if model_sub[0] == "deeplab":
-        model_class = DeepLabModel
-    else:
+# Segmentation models by their prefix, with the module and class that
+# implements them and the default model_name. The modules are only
+# imported when a model is created, since they import TensorFlow.
+SEGMENTATION_MODELS = {
+    "deeplab": {
+        "module": "greenstreet.models.deeplab",
+        "class": "DeepLabModel",
+        "default": "mobilenet",
+    },
+    "stub": {
+        "module": "greenstreet.models.stub",
+        "class": "StubModel",
+        "default": "color",
+    },
+}
+
+
+def get_model_class(model_base):
+    " Import the class of a segmentation model from the registry. "
+    try:
+        entry = SEGMENTATION_MODELS[model_base]
+    except KeyError:
+        raise ValueError(f"Unknown model: {model_base}")
+    return getattr(import_module(entry["module"]), entry["class"])
+
+
+def get_segmentation_model(model_type="deeplab-mobilenet", lazy=False,
+                           **kwargs):
+    """ Create a segmentation model from its type.
+
+    Arguments
+    ---------
+    model_type: str
+        "<model>-<model_name>", e.g. "deeplab-mobilenet".
+    lazy: bool
+        Only load the model when it is used for segmentation.
+
+    Returns
+    -------
+    object:
+        Segmentation model (or a LazySegmentationModel).
+    """
+    model_sub = model_type.split('-', 1)
+    if model_sub[0] not in SEGMENTATION_MODELS:
         raise ValueError(f"Unknown model: {model_sub[0]}/{model_type}")
 
-    extra_kwargs = {}
     if len(model_sub) > 1:
-        extra_kwargs = {'model_name': model_sub[1]}
-
-    return model_class(**kwargs, **extra_kwargs)
-
-
-def get_green_model(use_panorama=True, weighted_panorama=True):
+        model_name = model_sub[1]
+    else:
+        model_name = SEGMENTATION_MODELS[model_sub[0]]["default"]
+
+    if lazy:
+        return LazySegmentationModel(model_sub[0], model_name, **kwargs)
+    return get_model_class(model_sub[0])(model_name=model_name, **kwargs)
+
+
+class LazySegmentationModel():
+    """ Segmentation model that is loaded on first use.
+
+    The name of the model is available without loading it, so that
+    existing results can be found without importing TensorFlow. The model
+    is loaded only once, also when it is first used from several threads
+    (e.g. the decoders of an InferencePipeline).
+    """
+    def __init__(self, model_base, model_name, **kwargs):
+        self.model_base = model_base
+        self.model_name = model_name
+        self.model_kwargs = kwargs
+        self._model = None
+        self._load_lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.model_base + "-" + self.model_name
+
+    @property
+    def INPUT_SIZE(self):
+        if self._model is None:
+            return get_model_class(self.model_base).INPUT_SIZE
+        return self._model.INPUT_SIZE
+
+    def load(self):
+        " Create the model, if that has not been done yet. "
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    self._model = get_model_class(self.model_base)(
+                        model_name=self.model_name, **self.model_kwargs)
+        return self._model
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+
+def get_green_model(use_panorama=True, weighted_panorama=True,
+                    persist_weights=False):
+    """ Greenery model for a panorama type.
+
+    With persist_weights, the pixel weights are stored in (and memory
+    mapped from) <CACHE_DIR>/weights, so that processes share them.
+    """
     if not weighted_panorama:
         return GreeneryUnweighted()
+    weight_cache = None
+    if persist_weights:
+        weight_cache = WeightCache.shared(Path(CACHE_DIR, "weights"))
     if use_panorama:
-        return PanoramaWeighted()
-    return CubicWeighted()
+        return PanoramaWeighted(weight_cache=weight_cache)
+    return CubicWeighted(weight_cache=weight_cache)
 
 
-def get_job_runner(use_panorama, seg_model, green_model):
+def get_job_runner(use_panorama, seg_model, green_model, **kwargs):
     if use_panorama:
-        return AdamPanoramaJob(seg_model, green_model)
-    return AdamCubicJob(seg_model, green_model)
+        return AdamPanoramaJob(seg_model, green_model, **kwargs)
+    return AdamCubicJob(seg_model, green_model, **kwargs)
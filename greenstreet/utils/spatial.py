@@ -0,0 +1,92 @@
+'''
+Spatial index over panorama coordinates.
+'''
+
+import math
+import pickle
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+# Radius of the earth in meters (same as greenstreet.utils.sun).
+R_EARTH = 6356e3
+
+
+class SpatialIndex():
+    """ KD-tree over (longitude, latitude) coordinates.
+
+    Coordinates are scaled to meters (with the cos(latitude) correction of
+    the longitude at the average latitude), so that nearest neighbor
+    queries use distances that are (locally) correct.
+
+    Arguments
+    ---------
+    coordinates: np.array
+        (n, 2) array with longitude and latitude of each point.
+    """
+    # Increased whenever the scaling changes, to invalidate saved indices.
+    version = 2
+
+    def __init__(self, coordinates):
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        if len(coordinates):
+            avg_lat = float(np.mean(coordinates[:, 1]))
+        else:
+            avg_lat = 0.0
+        # Meters per degree of longitude and latitude.
+        self.scale = np.array([
+            math.pi/180*R_EARTH*math.cos(math.radians(avg_lat)),
+            math.pi/180*R_EARTH,
+        ])
+        self.version = SpatialIndex.version
+        self.n_points = len(coordinates)
+        self.tree = cKDTree(coordinates*self.scale)
+
+    def in_bbox(self, bbox):
+        """ Indices of all points within a bounding box.
+
+        Arguments
+        ---------
+        bbox: list
+            [[lat_SW, long_SW], [lat_NE, long_NE]]
+
+        Returns
+        -------
+        np.array:
+            Sorted indices of the points inside the (closed) bounding box.
+        """
+        low = np.array([bbox[0][1], bbox[0][0]])*self.scale
+        high = np.array([bbox[1][1], bbox[1][0]])*self.scale
+        if self.n_points == 0 or np.any(high < low):
+            return np.zeros(0, dtype=int)
+        center = (low+high)/2
+        radius = np.max(high-low)/2
+        idx = np.array(
+            self.tree.query_ball_point(center, radius*(1+1e-12), p=np.inf),
+            dtype=int)
+        points = self.tree.data[idx]
+        inside = np.all((points >= low) & (points <= high), axis=1)
+        return np.sort(idx[inside])
+
+    def nearest(self, lat, long, k=1):
+        """ Indices and distances (m) of the k nearest points to a point. """
+        k = min(k, self.n_points)
+        if k == 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        point = np.array([long, lat])*self.scale
+        dist, idx = self.tree.query(point, k=k)
+        return np.atleast_1d(idx), np.atleast_1d(dist)
+
+    def save(self, index_fp):
+        with open(index_fp, "wb") as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, index_fp):
+        " Load a saved index, None if it was saved by an older version. "
+        with open(index_fp, "rb") as f:
+            index = pickle.load(f)
+        if getattr(index, "version", 1) != cls.version:
+            return None
+        return index
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''
+Benchmark reduced scale (draft) JPEG decoding against decoding at full
+resolution, for the preprocessing of the segmentation model.
+
+Reports the decode + resize time and the agreement of the resized images.
+With a model type (e.g. deeplab-mobilenet), the segmentation maps of both
+are compared as well.
+
+Usage: ./draft_decoding.py picture_dir [model_type]
+'''
+
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+from greenstreet.models.base import SegmentationBackend, load_resized
+from greenstreet.utils.selection import get_segmentation_model
+
+
+def time_decoding(picture_files, draft):
+    t_start = perf_counter()
+    max_size = SegmentationBackend.INPUT_SIZE
+    arrays = [np.asarray(load_resized(picture_fp, max_size, draft=draft))
+              for picture_fp in picture_files]
+    return arrays, perf_counter() - t_start
+
+
+def main(picture_dir, model_type=None):
+    picture_files = sorted(Path(picture_dir).glob("**/*.jpg"))
+    if not len(picture_files):
+        print(f"No pictures found in {picture_dir}")
+        return
+
+    full_arrays, t_full = time_decoding(picture_files, draft=False)
+    draft_arrays, t_draft = time_decoding(picture_files, draft=True)
+
+    pixel_diff = np.mean([
+        np.mean(np.abs(full.astype(np.int16) - draft.astype(np.int16)))
+        for full, draft in zip(full_arrays, draft_arrays)])
+    print(f"{len(picture_files)} pictures")
+    print(f"full decoding:  {t_full:.3f} s")
+    print(f"draft decoding: {t_draft:.3f} s (speedup {t_full/t_draft:.1f})")
+    print(f"mean absolute pixel difference: {pixel_diff:.2f}")
+
+    if model_type is None:
+        return
+
+    model = get_segmentation_model(model_type)
+    full_seg = model.run_arrays(full_arrays)
+    draft_seg = model.run_arrays(draft_arrays)
+    agreement = np.mean([
+        np.mean(full["seg_map"] == draft["seg_map"])
+        for full, draft in zip(full_seg, draft_seg)])
+    print(f"segmentation agreement ({model.name}): {100*agreement:.2f}%")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    main(*sys.argv[1:3])
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+'''
+Benchmark GridQuery.sample_panoramas against the original loop based
+implementation, on synthetic meta data for grid levels 0-8.
+
+Usage: ./sample_panoramas.py [n_panoramas]
+'''
+
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from greenstreet.API.adam.meta import AdamMetaData
+from greenstreet.query import GridQuery
+from greenstreet.utils.sun import degree_to_meter
+
+
+def reference_sample(query, meta_data):
+    " The original (loop based) selection of panoramas. "
+    nx = 2**query.grid_level
+    ny = 2**query.grid_level
+    x_start = query.bbox[0][1]
+    x_end = query.bbox[1][1]
+    y_start = query.bbox[0][0]
+    y_end = query.bbox[1][0]
+    dx = (x_end-x_start)/nx
+    dy = (y_end-y_start)/ny
+
+    mini_tile_list = np.empty((ny, nx), dtype=object)
+    for iy, ix in np.ndindex(mini_tile_list.shape):
+        mini_tile_list[iy][ix] = []
+
+    coordinates = meta_data.coordinates()
+    for pano_id, coor in coordinates.items():
+        x, y = coor
+        ix = int((x-x_start)/dx)
+        iy = int((y-y_start)/dy)
+        if ix >= 0 and ix < nx and iy >= 0 and iy < ny:
+            mini_tile_list[ix][iy].append(pano_id)
+
+    load_ids = []
+    for iy, ix in np.ndindex(mini_tile_list.shape):
+        mini_tile = mini_tile_list[ix][iy]
+        if not len(mini_tile):
+            continue
+        min_dist = 10.0**10
+        idx_min = -1
+        x_base = x_start + dx*ix
+        y_base = y_start + dy*iy
+        y_fac, x_fac = degree_to_meter(y_base)
+        for i_meta in mini_tile:
+            x, y = coordinates[i_meta]
+            dist = ((x-x_base)*x_fac)**2 + ((y-y_base)*y_fac)**2
+            if dist < min_dist:
+                idx_min = i_meta
+                min_dist = dist
+        load_ids.append(idx_min)
+    return np.array(load_ids)
+
+
+def synthetic_meta(bbox, n_pano, seed=1234):
+    " Random panoramas in and slightly around the bounding box. "
+    np.random.seed(seed)
+    lat = np.random.uniform(bbox[0][0]-0.001, bbox[1][0]+0.001, n_pano)
+    long = np.random.uniform(bbox[0][1]-0.001, bbox[1][1]+0.001, n_pano)
+    meta = AdamMetaData()
+    meta.meta_data = {
+        f"pano_{i}": {
+            "pano_id": f"pano_{i}",
+            "geometry": {"coordinates": [long[i], lat[i], 0.0]},
+            "timestamp": "2017-05-01T12:00:00Z",
+            "tags": [],
+        }
+        for i in range(n_pano)
+    }
+    return meta
+
+
+def main(n_pano=20000):
+    bbox = [[52.35, 4.90], [52.36, 4.915]]
+    meta = synthetic_meta(bbox, n_pano)
+    print(f"{'level':>5} {'loop (s)':>10} {'vector (s)':>10} {'speedup':>8}"
+          f" {'equal':>6}")
+    for grid_level in range(9):
+        query = GridQuery(bbox, grid_level=grid_level)
+        meta.spatial_index
+
+        t_start = perf_counter()
+        ref_ids = reference_sample(query, meta)
+        t_ref = perf_counter() - t_start
+
+        t_start = perf_counter()
+        new_ids = query.sample_panoramas(meta)
+        t_new = perf_counter() - t_start
+
+        equal = np.array_equal(ref_ids, new_ids)
+        print(f"{grid_level:>5} {t_ref:>10.4f} {t_new:>10.4f}"
+              f" {t_ref/t_new:>8.1f} {str(equal):>6}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
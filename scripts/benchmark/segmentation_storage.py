@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+Benchmark the binary (npz) segmentation format against the JSON format
+(zlib + base64), for writing, reading, disk usage and recomputing the
+greenery from stored segmentations (which uses the run-length encoded seg
+maps of the npz format directly).
+
+Segmentation maps are made with the stub backend from the pictures in a
+directory, or from synthetic pictures if no directory is given.
+
+Usage: ./segmentation_storage.py [picture_dir] [n_panorama]
+'''
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+from greenstreet.API.base.job import save_segmentation, load_segmentation
+from greenstreet.models.stub import StubModel
+from greenstreet.greenery.greenery import CubicWeighted
+
+
+def synthetic_arrays(n_image, seed=1234):
+    " Smooth random pictures, so that the seg maps have realistic regions. "
+    np.random.seed(seed)
+    arrays = []
+    for _ in range(n_image):
+        small = np.random.randint(0, 256, size=(8, 16, 3), dtype=np.uint8)
+        arrays.append(np.kron(small, np.ones((64, 32, 1), dtype=np.uint8)))
+    return arrays
+
+
+def main(picture_dir=None, n_panorama=20):
+    model = StubModel()
+    green_model = CubicWeighted()
+    sides = ["front", "back", "left", "right"]
+    n_image = len(sides)*n_panorama
+    if picture_dir is None:
+        seg_results = model.run_arrays(synthetic_arrays(n_image))
+    else:
+        picture_files = sorted(Path(picture_dir).glob("**/*.jpg"))
+        picture_files = (picture_files*n_image)[:n_image]
+        seg_results = model.run_batch(picture_files)
+    panoramas = [dict(zip(sides, seg_results[i:i+len(sides)]))
+                 for i in range(0, n_image, len(sides))]
+
+    print(f"{'format':>6} {'write (s)':>10} {'read (s)':>10}"
+          f" {'green (s)':>10} {'size (kB)':>10} {'equal':>6}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for extension in ["json", "npz"]:
+            files = [Path(tmp_dir, f"pano_{i}.{extension}")
+                     for i in range(len(panoramas))]
+
+            t_start = perf_counter()
+            for seg_res, seg_fp in zip(panoramas, files):
+                save_segmentation(seg_res, seg_fp, panorama_type="benchmark",
+                                  segmentation_model=model.name)
+            t_write = perf_counter() - t_start
+
+            t_start = perf_counter()
+            loaded = [load_segmentation(seg_fp)[0] for seg_fp in files]
+            t_read = perf_counter() - t_start
+
+            t_start = perf_counter()
+            for seg_fp in files:
+                for image_seg in load_segmentation(
+                        seg_fp, decode=False)[0].values():
+                    green_model.transform(image_seg)
+            t_green = perf_counter() - t_start
+
+            size = sum(os.path.getsize(seg_fp) for seg_fp in files)
+            equal = all(
+                np.array_equal(seg_res[side]["seg_map"],
+                               new_seg_res[side]["seg_map"])
+                for seg_res, new_seg_res in zip(panoramas, loaded)
+                for side in sides)
+            print(f"{extension:>6} {t_write:>10.3f} {t_read:>10.3f}"
+                  f" {t_green:>10.3f} {size/1024:>10.1f} {str(equal):>6}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        main(sys.argv[1], int(sys.argv[2]))
+    elif len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+'''
+Benchmark the throughput of segmentation and greenery computation on a
+directory of pictures, with sequential batches and with the pipeline.
+
+The default model is the synthetic stub backend, so that the benchmark
+also runs without TensorFlow; the stub can emulate the inference time of
+a real model with a delay per image.
+
+Usage: ./segmentation_throughput.py picture_dir [model_type] [delay]
+'''
+
+import sys
+from pathlib import Path
+from time import perf_counter
+
+from greenstreet.utils.selection import get_segmentation_model,\
+    get_green_model
+from greenstreet.models.pipeline import InferencePipeline
+
+
+def main(picture_dir, model_type="stub-color", delay=0.0):
+    picture_files = sorted(Path(picture_dir).glob("**/*.jpg"))
+    if not len(picture_files):
+        print(f"No pictures found in {picture_dir}")
+        return
+
+    model_kwargs = {}
+    if model_type.startswith("stub"):
+        model_kwargs["delay"] = float(delay)
+    model = get_segmentation_model(model_type, **model_kwargs)
+    green_model = get_green_model(use_panorama=False, weighted_panorama=True)
+
+    for runner in [model, InferencePipeline(model)]:
+        t_start = perf_counter()
+        seg_results = runner.run_batch(picture_files)
+        t_seg = perf_counter() - t_start
+
+        t_start = perf_counter()
+        for seg_res in seg_results:
+            green_model.transform(seg_res)
+        t_green = perf_counter() - t_start
+
+        print(f"{type(runner).__name__}: {len(picture_files)} pictures,"
+              f" segmentation {len(picture_files)/t_seg:.1f} pictures/s,"
+              f" greenery {len(picture_files)/t_green:.1f} pictures/s")
+        if isinstance(runner, InferencePipeline):
+            print(runner.report())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    main(*sys.argv[1:4])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+Benchmark the startup cost of importing greenstreet, and check that the
+heavy dependencies (TensorFlow, matplotlib, pykrige, folium, sklearn) are
+not imported until they are needed.
+
+Every import is timed in a fresh interpreter. Exits with status 1 if a
+heavy module is imported by one of the light entry points.
+
+Usage: ./startup.py [n_repeat]
+'''
+
+import sys
+import json
+import subprocess
+
+
+HEAVY_MODULES = ["tensorflow", "matplotlib", "pykrige", "folium", "sklearn"]
+
+ENTRY_POINTS = [
+    "greenstreet",
+    "greenstreet.__main__",
+    "greenstreet.mapper",
+    "greenstreet.utils.selection",
+    "greenstreet.models",
+    "greenstreet.greenery",
+]
+
+_PROBE = '''
+import sys, json
+from time import perf_counter
+t_start = perf_counter()
+import {module}
+t_import = perf_counter() - t_start
+print(json.dumps({{
+    "time": t_import,
+    "loaded": [mod for mod in {heavy} if mod in sys.modules],
+}}))
+'''
+
+
+def probe(module):
+    " Import a module in a new interpreter. "
+    output = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(module=module,
+                                             heavy=HEAVY_MODULES)],
+        check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().split("\n")[-1])
+
+
+def main(n_repeat=3):
+    all_light = True
+    print(f"{'module':<30} {'import (s)':>10}  heavy modules loaded")
+    for module in ENTRY_POINTS:
+        results = [probe(module) for _ in range(n_repeat)]
+        t_import = min(res["time"] for res in results)
+        loaded = results[0]["loaded"]
+        all_light = all_light and not len(loaded)
+        print(f"{module:<30} {t_import:>10.3f}  {', '.join(loaded) or '-'}")
+    if not all_light:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import io
+import json
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from greenstreet.config import STATUS_OK, STATUS_FAIL
+from greenstreet.query import GridQuery
+from greenstreet.API.adam.meta import AdamMetaData
+from greenstreet.API.adam.meta_db import AdamMetaDatabase
+from greenstreet.API.adam.cubic_job import AdamCubicJob
+from greenstreet.API.base.tile import Tile
+from greenstreet.models.stub import StubModel
+from greenstreet.models.pipeline import InferencePipeline
+from greenstreet.utils.selection import get_green_model
+
+
+def jpeg_picture(color=(30, 200, 30)):
+    " JPEG content of a small picture of a single color. "
+    buffer = io.BytesIO()
+    Image.fromarray(np.full((64, 64, 3), color, dtype=np.uint8)).save(
+        buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def cubic_job(seg_model=None, use_pipeline=False, **kwargs):
+    if seg_model is None:
+        seg_model = StubModel()
+    seg_pipeline = InferencePipeline(seg_model) if use_pipeline else None
+    return AdamCubicJob(seg_model, get_green_model(False, True),
+                        seg_pipeline=seg_pipeline, **kwargs)
+
+
+def write_pictures(job, data_dir, corrupt_side=None):
+    picture_dir = Path(data_dir, "pictures")
+    picture_dir.mkdir(parents=True, exist_ok=True)
+    for side, pano_file in job.panorama_files().items():
+        content = b"not a picture" if side == corrupt_side else jpeg_picture()
+        Path(picture_dir, pano_file).write_bytes(content)
+
+
+def test_corrupt_picture_fails_one_panorama(tmp_path):
+    for use_pipeline in [False, True]:
+        job = cubic_job(use_pipeline=use_pipeline)
+        data_dirs = [Path(tmp_path, str(use_pipeline), "pics", f"pano_{i}")
+                     for i in range(3)]
+        for i_dir, data_dir in enumerate(data_dirs):
+            write_pictures(job, data_dir,
+                           corrupt_side="left" if i_dir == 1 else None)
+
+        results = job.segmentation_many(data_dirs)
+        assert [res["status"] for res in results] == [
+            STATUS_OK, STATUS_FAIL, STATUS_OK]
+        assert job.segmentation_done(data_dirs[0])
+        assert not job.segmentation_done(data_dirs[1])
+
+
+class MemoryDownloader():
+    " Downloader that serves the same picture for every url. "
+    def __init__(self):
+        self.n_fetch = 0
+
+    def fetch_all_content(self, urls):
+        self.n_fetch += len(urls)
+        return {key: jpeg_picture() for key in urls}
+
+    def fetch_all(self, downloads):
+        self.n_fetch += len(downloads)
+        for url, file_fp in downloads.values():
+            Path(file_fp).write_bytes(jpeg_picture())
+        return {key: True for key in downloads}
+
+
+class OtherStubModel(StubModel):
+    @property
+    def name(self):
+        return "stub-other"
+
+
+def synthetic_tile(tile_dir, bbox, n_pano=4, **kwargs):
+    " Tile with meta data of panoramas on the diagonal of its bbox. "
+    meta = AdamMetaData()
+    meta.meta_data = {}
+    for i_pano in range(n_pano):
+        frac = (i_pano + 0.5)/n_pano
+        lat = bbox[0][0] + frac*(bbox[1][0]-bbox[0][0])
+        long = bbox[0][1] + frac*(bbox[1][1]-bbox[0][1])
+        meta.meta_data[f"pano_{i_pano}"] = {
+            "pano_id": f"pano_{i_pano}",
+            "geometry": {"coordinates": [long, lat, 0.0]},
+            "timestamp": "2017-05-01T12:00:00Z",
+            "tags": [],
+            "cubic_img_baseurl": f"https://example.org/pano_{i_pano}/",
+        }
+    Path(tile_dir).mkdir(parents=True)
+    meta.to_file(Path(tile_dir, "meta.json"))
+    return Tile("tile", bbox, tile_dir, **kwargs)
+
+
+def run_tile(tile, job, query):
+    jobs = tile.get_jobs(job, query)
+    tile.prepare(jobs)
+    pano_ids = list(jobs)
+    results = job.execute_many([jobs[pano_id] for pano_id in pano_ids])
+    tile.submit_result(jobs, dict(zip(pano_ids, results)), job, query)
+    tile.save()
+    return dict(zip(pano_ids, results))
+
+
+def test_in_memory_rerun_with_other_model(tmp_path):
+    bbox = [[52.35, 4.90], [52.36, 4.91]]
+    query = GridQuery(bbox, grid_level=1)
+    tile = synthetic_tile(Path(tmp_path, "tile"), bbox)
+
+    downloader = MemoryDownloader()
+    job = cubic_job(downloader=downloader, in_memory=True)
+    results = run_tile(tile, job, query)
+    pano_ids = sorted(results)
+    assert len(pano_ids)
+    assert all(res[-1]["status"] == STATUS_OK for res in results.values())
+    assert not Path(tmp_path, "tile", "pics", pano_ids[0], "pictures",
+                    job.panorama_files()["front"]).exists()
+
+    # The pictures are not on disk, so they are downloaded again.
+    n_fetch = downloader.n_fetch
+    other_job = cubic_job(seg_model=OtherStubModel(), downloader=downloader,
+                          in_memory=True)
+    results = run_tile(Tile("tile", bbox, Path(tmp_path, "tile")),
+                       other_job, query)
+    assert sorted(results) == pano_ids
+    for pipe_res in results.values():
+        assert [res["status"] for res in pipe_res] == [STATUS_OK]*3
+    assert downloader.n_fetch == 2*n_fetch
+
+    # Everything is done now.
+    tile = Tile("tile", bbox, Path(tmp_path, "tile"))
+    assert tile.get_jobs(job, query) == {}
+    assert tile.get_jobs(other_job, query) == {}
+
+
+def test_packed_tile_reads_meta_data(tmp_path):
+    bbox = [[52.35, 4.90], [52.36, 4.91]]
+    query = GridQuery(bbox, grid_level=1)
+    meta_db = AdamMetaDatabase(Path(tmp_path, "meta.db"))
+    tile = synthetic_tile(Path(tmp_path, "tile"), bbox, meta_db=meta_db,
+                          use_packs=True)
+
+    job = cubic_job(downloader=MemoryDownloader(), meta_db=meta_db,
+                    use_packs=True)
+    jobs = tile.get_jobs(job, query)
+    tile.prepare(jobs)
+    meta_pack = tile.pack("meta")
+    assert sorted(meta_pack.keys()) == sorted(jobs)
+
+    for pano_id in jobs:
+        data_dir = Path(tmp_path, "tile", "pics", pano_id)
+        meta_data = job.pano_meta(data_dir)
+        assert meta_data == meta_db.pano_meta(pano_id)
+        assert meta_data["meta_data"]["cubic_img_baseurl"] == (
+            f"https://example.org/{pano_id}/")
+        assert not Path(data_dir, "meta.json").exists()
+
+    # The pack file takes precedence over the regional database.
+    pano_id = sorted(jobs)[0]
+    meta_pack.put(pano_id, json.dumps({"pano_id": "packed"}).encode())
+    assert job.pano_meta(Path(tmp_path, "tile", "pics", pano_id)) == {
+        "pano_id": "packed"}
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+from greenstreet.migrate import migrate, migrate_tile
+from greenstreet.API.base.job import save_segmentation, load_segmentation,\
+    segmentation_from_bytes
+from greenstreet.API.base.pack import open_pack, tile_pack_fp
+
+
+SEG_ID = "adam-cubic_stub"
+
+
+def segmentation(i_pano):
+    seg_map = np.zeros((16, 16), dtype=int)
+    seg_map[:i_pano+1] = 8
+    color_map = (np.array(["road", "vegetation"]),
+                 np.array([[128, 64, 128], [107, 142, 35]]))
+    return {side: {"seg_map": seg_map, "color_map": color_map}
+            for side in ["front", "back"]}
+
+
+def old_tile(tile_dir, n_pano=3):
+    " Tile with results of panoramas in the JSON formats. "
+    for i_pano in range(n_pano):
+        pano_dir = Path(tile_dir, "pics", f"pano_{i_pano}")
+        Path(pano_dir, "segmentations").mkdir(parents=True)
+        Path(pano_dir, "greenery").mkdir()
+        save_segmentation(segmentation(i_pano),
+                          Path(pano_dir, "segmentations", SEG_ID + ".json"),
+                          "adam-cubic", "stub")
+        with open(Path(pano_dir, "greenery", SEG_ID + "_green.json"),
+                  "w") as f:
+            json.dump({"vegetation": i_pano/10}, f)
+        with open(Path(pano_dir, "meta.json"), "w") as f:
+            json.dump({"pano_id": f"pano_{i_pano}"}, f)
+
+
+def assert_same_segmentation(seg_data, i_pano):
+    seg_res, panorama_type, segmentation_model = seg_data
+    assert (panorama_type, segmentation_model) == ("adam-cubic", "stub")
+    assert list(seg_res) == ["front", "back"]
+    for image_seg in seg_res.values():
+        assert np.array_equal(image_seg["seg_map"],
+                              segmentation(i_pano)["front"]["seg_map"])
+
+
+def test_migrate_npz(tmp_path):
+    tile_dir = Path(tmp_path, "amsterdam", "tile_0")
+    old_tile(tile_dir)
+
+    summary = migrate(tmp_path, n_worker=2)
+    assert (summary["n_converted"], summary["n_skipped"],
+            summary["n_failed"]) == (3, 0, 0)
+    for i_pano in range(3):
+        seg_fp = Path(tile_dir, "pics", f"pano_{i_pano}", "segmentations",
+                      SEG_ID + ".npz")
+        assert_same_segmentation(load_segmentation(seg_fp), i_pano)
+        assert seg_fp.with_suffix(".json").is_file()
+    assert not Path(tile_dir, "packs").exists()
+
+    # Converted results are skipped and the originals removed.
+    tile_res = migrate_tile(tile_dir, remove=True)
+    assert (tile_res["n_converted"], tile_res["n_skipped"]) == (0, 3)
+    assert not list(Path(tile_dir).glob("pics/*/segmentations/*.json"))
+    assert len(list(Path(tile_dir).glob("pics/*/segmentations/*.npz"))) == 3
+    assert len(list(Path(tile_dir).glob("pics/*/greenery/*.json"))) == 3
+
+
+def test_migrate_packs(tmp_path):
+    tile_dir = Path(tmp_path, "tile_0")
+    old_tile(tile_dir)
+
+    tile_res = migrate_tile(tile_dir, use_packs=True)
+    assert (tile_res["n_converted"], tile_res["n_failed"]) == (9, 0)
+    seg_pack = open_pack(tile_pack_fp(tile_dir, "segmentation"))
+    green_pack = open_pack(tile_pack_fp(tile_dir, "greenery"))
+    meta_pack = open_pack(tile_pack_fp(tile_dir, "meta"))
+    for i_pano in range(3):
+        pano_id = f"pano_{i_pano}"
+        assert_same_segmentation(
+            segmentation_from_bytes(seg_pack.get(f"{SEG_ID}/{pano_id}")),
+            i_pano)
+        assert json.loads(green_pack.get(f"{SEG_ID}_green/{pano_id}")) == {
+            "vegetation": i_pano/10}
+        assert json.loads(meta_pack.get(pano_id)) == {"pano_id": pano_id}
+    assert len(list(Path(tile_dir, "pics").glob("*/*/*.json"))) == 6
+
+    # A changed original is not removed.
+    with open(Path(tile_dir, "pics", "pano_0", "meta.json"), "w") as f:
+        json.dump({"pano_id": "changed"}, f)
+    tile_res = migrate_tile(tile_dir, use_packs=True, remove=True)
+    assert (tile_res["n_converted"], tile_res["n_skipped"],
+            tile_res["n_failed"]) == (0, 8, 1)
+    assert [fp.name for fp in Path(tile_dir, "pics").glob("**/*")
+            if fp.is_file()] == ["meta.json"]
+    assert sorted(fp.name for fp in Path(tile_dir, "pics").iterdir()) == [
+        "pano_0"]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import os
+from pathlib import Path
+
+from greenstreet.API.base.pack import PackFile, batch_writes
+
+
+def test_put_get(tmp_path):
+    pack = PackFile(Path(tmp_path, "packs", "test.pack"))
+    pack.put("a", b"first")
+    pack.put_many([("b", b"second"), ("c", b"")])
+    assert pack.get("a") == b"first"
+    assert pack.get("b") == b"second"
+    assert pack.get("c") == b""
+    assert pack.get("d") is None
+    assert "a" in pack and "d" not in pack
+    assert len(pack) == 3
+
+    # A new version replaces the old one, also for other readers.
+    pack.put("a", b"new version")
+    assert pack.get("a") == b"new version"
+    assert PackFile(pack.pack_fp).get("a") == b"new version"
+    assert len(pack) == 3
+
+    pack.delete("b")
+    assert pack.get("b") is None
+    assert pack.keys() == ["c", "a"]
+
+
+def test_compact(tmp_path):
+    pack = PackFile(Path(tmp_path, "test.pack"))
+    for i_version in range(5):
+        pack.put_many([(f"key_{i}", f"{i_version}_{i}".encode()*100)
+                       for i in range(10)])
+    pack.delete("key_0")
+
+    old_size, new_size = pack.compact()
+    assert old_size == 5*new_size*10/9
+    assert new_size == os.path.getsize(pack.pack_fp)
+    assert pack.get("key_0") is None
+    for i in range(1, 10):
+        assert pack.get(f"key_{i}") == f"4_{i}".encode()*100
+
+    # The headers of the compacted pack file still describe the records.
+    pack.conn.execute("DELETE FROM record")
+    pack.rebuild_index()
+    assert len(pack) == 9
+    assert pack.get("key_9") == b"4_9"*100
+
+
+def test_batch_writes(tmp_path):
+    pack = PackFile(Path(tmp_path, "test.pack"))
+    with batch_writes():
+        pack.put("a", b"data")
+        pack.put("a", b"newer data")
+        # Buffered records are readable, but not written yet.
+        assert pack.get("a") == b"newer data"
+        assert "a" in pack
+        assert os.path.getsize(pack.pack_fp) == 0
+    assert os.path.getsize(pack.pack_fp) > 0
+    assert PackFile(pack.pack_fp).get("a") == b"newer data"
+    assert len(pack) == 1
+
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import math
+
+import numpy as np
+
+from greenstreet.utils.spatial import SpatialIndex, R_EARTH
+
+
+def haversine(lat_1, long_1, lat_2, long_2):
+    " Great circle distance (m) between two points. "
+    phi_1, phi_2 = math.radians(lat_1), math.radians(lat_2)
+    d_phi = phi_2 - phi_1
+    d_lambda = math.radians(long_2 - long_1)
+    a = (math.sin(d_phi/2)**2 +
+         math.cos(phi_1)*math.cos(phi_2)*math.sin(d_lambda/2)**2)
+    return 2*R_EARTH*math.asin(math.sqrt(a))
+
+
+def test_nearest_distance():
+    lat, long = 52.37, 4.90
+    # One point 0.01 degree north, one 0.01 degree east.
+    index = SpatialIndex(np.array([[long, lat+0.01], [long+0.01, lat]]))
+    idx, dist = index.nearest(lat, long, k=2)
+
+    # East is closer, since a degree of longitude is shorter.
+    assert idx.tolist() == [1, 0]
+    assert math.isclose(dist[0], haversine(lat, long, lat, long+0.01),
+                        rel_tol=1e-3)
+    assert math.isclose(dist[1], haversine(lat, long, lat+0.01, long),
+                        rel_tol=1e-3)
+    assert math.isclose(dist[1], 1109, rel_tol=1e-3)
+
+
+if __name__ == "__main__":
+    test_nearest_distance()
@@ -47,12 +47,11 @@ setup(
         'Development Status :: 3 - Alpha',
         'License :: OSI Approved :: Apache Software License',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
     ],
     keywords='greenery streetview machine learning',
     packages=find_packages(exclude=['docs', 'scripts']),
-    python_requires='~=3.6',
+    python_requires='>=3.7',
     install_requires=[
         'Pillow',
         'numpy',